@@ -9,19 +9,40 @@ Authors:
 
 
 import sim.api as api
+import sim.core as core
 
 
 # Host discovery packets are treated as an implementation detail --
 # they're how we know when to call add_static_route().  Thus, we make
 # them invisible in the simulator.
 from sim.basics import HostDiscoveryPacket
-HostDiscoveryPacket.outer_color = [0, 0, 0, 0]
-HostDiscoveryPacket.inner_color = [0, 0, 0, 0]
+HostDiscoveryPacket._default_outer_color = (0, 0, 0, 0)
+HostDiscoveryPacket._default_inner_color = (0, 0, 0, 0)
 
 
 
+class _RouteAdvertisement (api.Packet):
+  """
+  Base class for the packets that carry DV route advertisements
+
+  These all look the same and count as routing traffic for convergence
+  (see Convergence).
+  """
+  _default_outer_color = (1, 0, 1, 1)
+  _default_inner_color = (1, 0, 1, 1)
+
+  def _notify_tx (self, srcEnt, srcPort, dstEnt, dstPort, drop):
+    super(_RouteAdvertisement, self)._notify_tx(srcEnt, srcPort,
+                                                dstEnt, dstPort, drop)
+    if not drop: convergence._sent(self)
+
+  def _notify_rx (self, srcEnt, srcPort, dstEnt, dstPort, drop):
+    convergence._received(self)
+    super(_RouteAdvertisement, self)._notify_rx(srcEnt, srcPort,
+                                                dstEnt, dstPort, drop)
+
 #TODO: Make this a namedtuple?
-class RoutePacket (api.Packet):
+class RoutePacket (_RouteAdvertisement):
   """
   A DV route advertisement
 
@@ -34,13 +55,28 @@ class RoutePacket (api.Packet):
     super(RoutePacket, self).__init__()
     self.latency = latency
     self.destination = destination
-    self.outer_color = [1, 0, 1, 1]
-    self.inner_color = [1, 0, 1, 1]
 
   def __repr__ (self):
     return "<RoutePacket to %s at cost %s>" % (
         self.destination, self.latency)
 
+class RouteBatchPacket (_RouteAdvertisement):
+  """
+  Several DV route advertisements in one packet
+
+  routes is a tuple of (destination, latency) pairs.  DVRouterBase sends
+  these instead of individual RoutePackets if its ROUTE_BATCH_SIZE is set,
+  and unpacks them into handle_route_advertisement() calls on receipt, so
+  routers don't need to know about them.  It's not a RoutePacket, since
+  there's no single .destination or .latency.
+  """
+  def __init__ (self, routes):
+    super(RouteBatchPacket, self).__init__()
+    self.routes = tuple(routes)
+
+  def __repr__ (self):
+    return "<RouteBatchPacket with %s routes>" % (len(self.routes),)
+
 class Ports:
   def __init__ (self):
     self.link_to_lat = {}
@@ -69,6 +105,7 @@ class DVRouterBase (api.Entity):
     TIMER_INTERVAL = 5  # Default timer interval.
     ROUTE_TTL = 15
     GARBAGE_TTL = 10
+    ROUTE_BATCH_SIZE = None # If set, batch routes (see send_route())
 
     def start_timer (self, interval=None):
       """
@@ -81,7 +118,7 @@ class DVRouterBase (api.Entity):
       if interval is None:
         interval = self.TIMER_INTERVAL
         if interval is None: return
-      api.create_timer(interval, self.handle_timer)
+      api.create_timer(interval, self.handle_timer, coalesce=True)
 
     def handle_rx (self, packet, port):
       """
@@ -93,7 +130,11 @@ class DVRouterBase (api.Entity):
 
       !!! DO NOT OVERRIDE THIS METHOD !!!
       """
-      if isinstance(packet, RoutePacket):
+      if isinstance(packet, RouteBatchPacket):
+        self.expire_routes()
+        for dst, latency in packet.routes:
+          self.handle_route_advertisement(dst, latency, port)
+      elif isinstance(packet, RoutePacket):
         self.expire_routes()
         self.handle_route_advertisement(packet.destination,
                                         packet.latency,
@@ -139,10 +180,33 @@ class DVRouterBase (api.Entity):
     def send_route(self, port, dst, latency):
       """
       Creates a control packet from dst and lat and sends it.
-      """
 
-      pkt = RoutePacket(destination=dst, latency=latency)
-      self.send(pkt, port=port)
+      If ROUTE_BATCH_SIZE is set, routes for the same port are instead
+      collected and sent together in RouteBatchPackets of up to that many
+      routes, once the current event is done (or the batch is full).
+      """
+      if self.ROUTE_BATCH_SIZE is None:
+        pkt = RoutePacket(destination=dst, latency=latency)
+        self.send(pkt, port=port)
+        return
+
+      batches = self.__dict__.get("_route_batches")
+      if batches is None:
+        # Nothing collected yet in this event
+        batches = self._route_batches = {} # port -> [(dst, latency)]
+        core.world.do(self._send_route_batches)
+      batch = batches.setdefault(port, [])
+      batch.append((dst, latency))
+      if len(batch) >= self.ROUTE_BATCH_SIZE:
+        del batches[port]
+        self.send(RouteBatchPacket(batch), port=port)
+
+    def _send_route_batches (self):
+      """ Sends the routes send_route() has collected """
+      batches = self._route_batches
+      self._route_batches = None
+      for port, batch in batches.items():
+        self.send(RouteBatchPacket(batch), port=port)
     
     def s_log(self, format, *args):
       """
@@ -164,6 +228,7 @@ class DVRouterBase (api.Entity):
 
 #import abc
 from collections import namedtuple
+import weakref
 from numbers import Number  # Available in Python >= 2.7.
 import unittest
 
@@ -212,6 +277,9 @@ class Table (_ValidatedDict):
 
   You should use a `Table` instance as a `dict` that maps a
   destination host to a `TableEntry` object.
+
+  Changes to routes (but not just refreshing them) are reported to
+  `convergence`.
   """
   owner = None
 
@@ -227,6 +295,41 @@ class Table (_ValidatedDict):
       raise ValueError("entry destination %s doesn't match key %s" %
                (entry.dst, dst))
 
+  def __setitem__ (self, dst, entry):
+    old = self.get(dst)
+    super(Table, self).__setitem__(dst, entry)
+    if old is None or (old.port, old.latency) != (entry.port, entry.latency):
+      convergence._changed()
+
+  def __delitem__ (self, dst):
+    super(Table, self).__delitem__(dst)
+    convergence._changed()
+
+  def pop (self, dst, *default):
+    had = dst in self
+    r = super(Table, self).pop(dst, *default)
+    if had: convergence._changed()
+    return r
+
+  def popitem (self):
+    r = super(Table, self).popitem()
+    convergence._changed()
+    return r
+
+  def setdefault (self, dst, entry = None):
+    if dst not in self:
+      self[dst] = entry
+    return self[dst]
+
+  def clear (self):
+    had = bool(self)
+    super(Table, self).clear()
+    if had: convergence._changed()
+
+  def update (self, *args, **kwargs):
+    for dst,entry in dict(*args, **kwargs).items():
+      self[dst] = entry
+
   def __str__ (self):
     o = "=== Table"
     if self.owner and getattr(self.owner, 'name'):
@@ -296,6 +399,83 @@ class TableEntry (namedtuple("TableEntry",
          self.expire_time - current_time())
 
 
+class Convergence (object):
+  """
+  Notices when routing has converged
+
+  Every change to a routing Table (a route being added, removed, or moved
+  to a different port or latency -- but not just being refreshed) counts
+  as activity.  Once there's been none for quiet_period seconds and no
+  route advertisements (RoutePackets or RouteBatchPackets) are on the
+  wire, routing has converged as of the last change.  At that point, it's
+  logged, converged_at is set, and callbacks registered with on_converged()
+  are called with that time.  Any later change makes it unconverged again.
+
+  There's one of these: convergence.
+  """
+  def __init__ (self, quiet_period = 2 * DVRouterBase.TIMER_INTERVAL):
+    self.quiet_period = quiet_period
+    self.changes = 0
+    self.last_change = None
+    self.converged_at = None
+    self._in_flight = weakref.WeakSet() # Advertisements on the wire
+    self._timer = None # Pending check (see _check())
+    self._waiting = False # Quiet, but waiting for the wires to clear
+    self._callbacks = []
+
+  @property
+  def converged (self):
+    return self.converged_at is not None
+
+  @property
+  def in_flight (self):
+    """ The number of route advertisements currently on the wire """
+    return len(self._in_flight)
+
+  def on_converged (self, callback):
+    """ Calls callback(time) whenever routing converges """
+    self._callbacks.append(callback)
+
+  def _changed (self):
+    self.changes += 1
+    if core.world is None: return # Tables being used on their own
+    self.last_change = current_time()
+    self.converged_at = None
+    self._waiting = False
+    if self._timer is None:
+      self._timer = api.create_timer(self.quiet_period, self._check,
+                                     recurring=False)
+
+  def _check (self):
+    """ Called when it may have been quiet for long enough """
+    self._timer = None
+    remaining = self.last_change + self.quiet_period - current_time()
+    if remaining > 0:
+      # Something changed since we scheduled this
+      self._timer = api.create_timer(remaining, self._check, recurring=False)
+    elif self._in_flight:
+      self._waiting = True
+    else:
+      self._converge()
+
+  def _sent (self, packet):
+    self._in_flight.add(packet)
+
+  def _received (self, packet):
+    self._in_flight.discard(packet)
+    if self._waiting and not self._in_flight:
+      self._converge()
+
+  def _converge (self):
+    self._waiting = False
+    self.converged_at = self.last_change
+    api.simlog.info("Routing converged at %s", self.converged_at)
+    for callback in self._callbacks:
+      callback(self.converged_at)
+
+convergence = Convergence()
+
+
 
 #FIXME: add port tests
 class TestTableEntry (unittest.TestCase):
@@ -379,3 +559,143 @@ class TestTableEntry (unittest.TestCase):
     self.assertTrue(rte1 == rte2)
     self.assertFalse(rte1 != rte2)
     self.assertEqual(hash(rte1), hash(rte2))
+
+
+class TestTableChanges (unittest.TestCase):
+  """Checks that Table reports changes (and only changes) to convergence."""
+  def setUp (self):
+    self.h1 = HostEntity()
+    self.h1.name = "h1"
+    self.h2 = HostEntity()
+    self.h2.name = "h2"
+    self.table = Table()
+    self.table[self.h1] = TableEntry(self.h1, 1, 10, FOREVER)
+
+  def entry (self, dst, port = 1, latency = 10):
+    return TableEntry(dst, port, latency, FOREVER)
+
+  def assertChanges (self, n, f, *args):
+    """Checks that calling f(*args) makes n changes."""
+    before = convergence.changes
+    f(*args)
+    self.assertEqual(convergence.changes - before, n)
+
+  def test_setitem (self):
+    self.assertChanges(1, self.table.__setitem__, self.h2, self.entry(self.h2))
+    self.assertChanges(1, self.table.__setitem__, self.h1,
+                       self.entry(self.h1, latency=5))
+    self.assertChanges(1, self.table.__setitem__, self.h1,
+                       self.entry(self.h1, port=2, latency=5))
+
+  def test_refresh (self):
+    """Just refreshing a route (a new expire time) isn't a change."""
+    self.assertChanges(0, self.table.__setitem__, self.h1,
+                       TableEntry(self.h1, 1, 10, 300))
+
+  def test_delitem (self):
+    self.assertChanges(1, self.table.__delitem__, self.h1)
+
+  def test_pop (self):
+    self.assertChanges(1, self.table.pop, self.h1)
+    self.assertChanges(0, self.table.pop, self.h1, None)
+
+  def test_popitem (self):
+    self.assertChanges(1, self.table.popitem)
+
+  def test_setdefault (self):
+    self.assertChanges(1, self.table.setdefault, self.h2, self.entry(self.h2))
+    self.assertChanges(0, self.table.setdefault, self.h2, self.entry(self.h2))
+
+  def test_clear (self):
+    self.assertChanges(1, self.table.clear)
+    self.assertChanges(0, self.table.clear)
+
+  def test_update (self):
+    self.assertChanges(2, self.table.update, {
+        self.h1: self.entry(self.h1, latency=1),
+        self.h2: self.entry(self.h2)})
+    with self.assertRaises(ValueError):
+      self.table.update({self.h1: self.entry(self.h2)})
+
+
+class TestConvergence (unittest.TestCase):
+  """Checks when Convergence decides routing has converged."""
+  def setUp (self):
+    import sim
+    global convergence
+    self.saved = (core.world, core.events, convergence,
+                  sim.config.remote_interface, sim.config.virtual_time)
+    sim.config.remote_interface = None
+    sim.config.virtual_time = True
+    self.world = core.World()
+    convergence = Convergence(quiet_period=10)
+
+    self.h1 = HostEntity()
+    self.h1.name = "h1"
+    self.table = Table()
+
+  def tearDown (self):
+    import sim
+    global convergence
+    (core.world, core.events, convergence,
+     sim.config.remote_interface, sim.config.virtual_time) = self.saved
+
+  def change (self, latency):
+    self.table[self.h1] = TableEntry(self.h1, 1, latency, FOREVER)
+
+  def test_quiet_period (self):
+    self.world.run_until(1)
+    self.change(10)
+    self.world.run_until(10.5)
+    self.assertFalse(convergence.converged)
+    self.world.run_until(11)
+    self.assertTrue(convergence.converged)
+    self.assertEqual(convergence.converged_at, 1)
+
+    # Another change starts the clock again
+    self.world.run_until(15)
+    self.change(5)
+    self.assertFalse(convergence.converged)
+    self.world.run_until(24)
+    self.change(7)
+    self.world.run_until(30)
+    self.assertFalse(convergence.converged)
+    self.world.run_until(34)
+    self.assertTrue(convergence.converged)
+    self.assertEqual(convergence.converged_at, 24)
+    self.assertEqual(convergence.changes, 3)
+
+  def test_in_flight (self):
+    """An advertisement still on the wire holds off convergence."""
+    packet = RoutePacket(self.h1, 10)
+    self.world.run_until(1)
+    self.change(10)
+    packet._notify_tx(None, 0, self.h1, 0, False)
+    self.assertEqual(convergence.in_flight, 1)
+    self.world.run_until(20)
+    self.assertFalse(convergence.converged)
+    packet._notify_rx(None, 0, self.h1, 0, False)
+    self.assertEqual(convergence.in_flight, 0)
+    self.assertTrue(convergence.converged)
+    self.assertEqual(convergence.converged_at, 1)
+
+  def test_dropped (self):
+    """Dropped advertisements aren't waited for."""
+    packet = RoutePacket(self.h1, 10)
+    self.world.run_until(1)
+    self.change(10)
+    packet._notify_tx(None, 0, self.h1, 0, True)
+    self.world.run_until(11)
+    self.assertTrue(convergence.converged)
+
+  def test_batch (self):
+    """Batched advertisements are waited for too."""
+    packet = RouteBatchPacket([(self.h1, 10)])
+    self.assertFalse(isinstance(packet, RoutePacket))
+    self.world.run_until(1)
+    self.change(10)
+    packet._notify_tx(None, 0, self.h1, 0, False)
+    self.world.run_until(20)
+    self.assertFalse(convergence.converged)
+    packet._notify_rx(None, 0, self.h1, 0, False)
+    self.assertTrue(convergence.converged)
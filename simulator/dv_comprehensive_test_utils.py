@@ -1,6 +1,6 @@
 from collections import defaultdict
 import weakref
-from cs168.dv import RoutePacket
+from cs168.dv import RoutePacket, RouteBatchPacket
 import sim.api as api
 from sim.basics import BasicHost, Ping
 import sim.cable
@@ -26,7 +26,7 @@ class TestHost(BasicHost):
         self.rxed_pings.clear()
 
     def handle_rx(self, packet, port):
-        if isinstance(packet, RoutePacket):
+        if isinstance(packet, (RoutePacket, RouteBatchPacket)):
             self.routes += 1
         elif isinstance(packet, Ping):
             self.rxed_pings[packet.src].append((packet, api.current_time()))
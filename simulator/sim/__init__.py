@@ -24,6 +24,22 @@ class SimConfiguration (object):
 
   debug_startup = False
 
+  virtual_time = False # Run as fast as possible instead of in real time
+  time_scale = 1.0 # Simulated seconds per real second (when not virtual)
+  stats_info = False # Show World.stats in NetVis's info box
+  trace_file = None # Where to dump the event trace (see core.Tracer)
+  trace_size = 65536 # How many events the trace holds
+  profile = False # Time event handlers (see core.Profiler)
+  profile_file = None # Where to write the profile as JSON at exit
+  record_file = None # Record the run here (see sim.replay)
+  record_seed = None # Random seed for recording (None picks one)
+  replay_file = None # Replay the run recorded here
+  parallel = 1 # Number of worker processes (see sim.pdes)
+  asyncio = False # Run on an asyncio event loop (see sim.aio)
+  batch = False # Run headless and write a report (see sim.batch)
+  until = None # When a batch run stops (None means when things are quiet)
+  report_file = None # Where a batch run writes its report (None is stdout)
+
   remote_interface = "tcp" # Probably "tcp", "udp", or None
   remote_interface_address = "127.0.0.1"
   remote_interface_port = 4444
@@ -74,6 +90,21 @@ def _try_import (name, verbose = None):
     return None
 
 
+def profile_report (sort = "total", limit = 30):
+  """
+  Prints how much time has gone into each kind of event handler
+
+  Profiling has to be turned on with the --profile option.  sort can be
+  any of calls, total, mean, p50, p99, or max.
+  """
+  import sim.core as core
+  profiler = core.world.profiler if core.world else None
+  if profiler is None:
+    print("Profiling is off (use --profile)")
+    return
+  print(profiler.report(sort, limit))
+
+
 def _issubclass (sub, sup):
   # If you call ischild(my_pen, an_elephant), the answer is obviously False
   # and not an exception because my_pen is not an elephant.  Why Python's
@@ -0,0 +1,199 @@
+"""
+Running the simulator on an asyncio event loop
+
+Normally the world has a thread of its own which waits on a condition
+variable for the next event, and the remote interfaces have a listener
+thread plus a thread per connection.  With boot's --asyncio option (or
+by awaiting run() yourself), the world runs as a task on an asyncio
+event loop instead: each event is dispatched from a loop callback set
+with loop.call_at() for when it's due (or as soon as possible, in
+virtual time), and the TCP and web interfaces are served with asyncio
+streams on the same loop (see sim.comm_aio).  So NetVis commands and
+the events they schedule don't need to be handed from one thread to
+another, and the simulator can be embedded in other asyncio code:
+
+  import sim.aio
+  await sim.aio.run()              # Or create_task() it
+
+Events scheduled from outside an event -- by other coroutines, or by
+other threads such as the console -- go through the world's inbox and
+wake the loop, just as they would wake the simulation thread.  Blocking
+calls like World.sleep() can't be used from the loop; use sleep() here.
+"""
+
+from __future__ import print_function
+import asyncio
+import threading
+
+import sim.core as core
+from sim.core import simlog, _get_ident
+
+
+class _Wakeup (threading.Condition):
+  """
+  The world's wakeup condition, but notifying also wakes the runner
+
+  Other threads (and coroutines outside of events) notify this when they
+  put things in the inbox, stop the world, and so on.
+  """
+  def __init__ (self, runner):
+    threading.Condition.__init__(self)
+    self.runner = runner
+
+  def notify (self, n = 1):
+    threading.Condition.notify(self, n)
+    self.runner._wake()
+
+
+class Runner (object):
+  """
+  Dispatches a world's events from an asyncio event loop
+  """
+  BATCH = 1000 # Most events to dispatch before letting the loop run I/O
+
+  def __init__ (self, world, loop):
+    self.world = world
+    self.loop = loop
+    self.done = loop.create_future()
+    self.exit = None # SystemExit raised by an event
+    self._ident = None # The loop thread's ident
+    self._handle = None # When we're next going to run
+    self._woken = False # Whether a wakeup is on its way
+
+  def start (self):
+    world = self.world
+    if world._thread is None:
+      world._thread = threading.current_thread()
+    elif world._thread is not threading.current_thread():
+      raise RuntimeError("The world is running in another thread")
+    self._ident = _get_ident()
+    world._wakeup = _Wakeup(self)
+    # Outside of events, the loop thread schedules things via the inbox so
+    # that we hear about them (see _step())
+    world._ident = self._ident
+    world._flush_prelist()
+    world._ident = None
+    world._running = True
+    simlog.debug("Running on asyncio event loop")
+    self._arm()
+
+  def _wake (self):
+    """ Makes the runner look at things again (callable from anywhere) """
+    if self._woken: return
+    self._woken = True
+    if _get_ident() == self._ident:
+      self.loop.call_soon(self._on_wake)
+    else:
+      self.loop.call_soon_threadsafe(self._on_wake)
+
+  def _on_wake (self):
+    self._woken = False
+    if self.done.done(): return
+    if self._handle is not None:
+      self._handle.cancel()
+      self._handle = None
+    self._arm()
+
+  def _arm (self):
+    """ Sets up a callback for whenever the next event is due """
+    world = self.world
+    if not world._running:
+      self._finish()
+      return
+    world._drain_inbox()
+    o = world._next_event()
+    if o is None: return # Until something wakes us up
+    if world.virtual_time:
+      self._handle = self.loop.call_soon(self._step)
+    else:
+      delay = (o[0] - world.time) / world.time_scale
+      self._handle = self.loop.call_at(self.loop.time() + delay, self._step)
+
+  def _step (self):
+    """ Dispatches whatever is due (up to BATCH events) """
+    self._handle = None
+    world = self.world
+    virtual = world.virtual_time
+    stats = world.stats
+    world._ident = self._ident
+    try:
+      for _ in range(self.BATCH):
+        if not world._running: break
+        world._drain_inbox()
+        o = world._next_event()
+        if o is None: break
+        if virtual:
+          world._pop_event(o)
+          if o[0] > world._time:
+            world._time = o[0]
+        else:
+          now = world.time
+          lag = now - o[0]
+          if lag < 0: break # Not due yet
+          world._pop_event(o)
+          stats.add_lag(lag)
+          if now >= stats.next_sample:
+            stats.sample(world, o[0])
+        world._dispatch(o)
+    except SystemExit as e:
+      simlog.debug("Simulation stopped")
+      self.exit = e
+      world._running = False
+    except Exception:
+      simlog.exception("Simulation ended due to exception")
+      world._running = False
+    finally:
+      world._ident = None
+    self._arm()
+
+  def cancel (self):
+    """ Stops running (e.g., because our task was cancelled) """
+    self.world._running = False
+    if self._handle is not None:
+      self._handle.cancel()
+      self._handle = None
+    self._finish()
+
+  def _finish (self):
+    world = self.world
+    if self.done.done(): return
+    simlog.debug("Simulation ended")
+    world.ended = True
+    world._dump_trace()
+    self.done.set_result(None)
+
+
+async def run (world = None):
+  """
+  Runs the world on the current event loop until it stops
+
+  If the remote interface is one from sim.comm_aio, it's served on the
+  loop too.  If an event called sys.exit(), so does this.
+  """
+  if world is None: world = core.world
+  runner = Runner(world, asyncio.get_running_loop())
+  serve = getattr(core.events, "serve", None)
+  if serve is not None:
+    await serve()
+  runner.start()
+  try:
+    await asyncio.shield(runner.done)
+  except asyncio.CancelledError:
+    runner.cancel()
+    raise
+  finally:
+    close = getattr(core.events, "close", None)
+    if close is not None:
+      await close()
+  if runner.exit is not None:
+    raise runner.exit
+
+
+async def sleep (seconds, world = None):
+  """ Waits for the given number of simulated seconds """
+  if world is None: world = core.world
+  future = asyncio.get_running_loop().create_future()
+  def wakeup ():
+    if not future.done(): future.set_result(None)
+  world.doLater(seconds, wakeup)
+  await future
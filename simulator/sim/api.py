@@ -4,7 +4,8 @@ The main APIs for the simulator
 
 from __future__ import print_function
 import sim.core as core
-from random import random as rand
+import random as _random
+import unittest
 
 # Non-routable packets may not really have addresses.  We just create a
 # more meaningful name for None for these cases.
@@ -31,7 +32,7 @@ def get_name (entity):
 
 
 def create_timer (seconds, target, recurring = True, pass_self = False,
-                  args=(), kw={}):
+                  args=(), kw={}, coalesce = False):
   """
   Create a timer
 
@@ -39,14 +40,19 @@ def create_timer (seconds, target, recurring = True, pass_self = False,
   it the specified positional and keyword arguments.
   Will also pass itself as a final positional argument if pass_self
   is True.
+  If coalesce is True, the timer may go off a tiny bit early or late so
+  that it can share a single simulator event with other coalescing timers
+  that have the same period.  This is much cheaper when there are lots.
   You can call .cancel() on the returned timer object to cancel it.
   """
   if recurring:
     return core.Timer(seconds, target=target,
-                      passSelf=pass_self, args=args, kw=kw)
+                      passSelf=pass_self, args=args, kw=kw,
+                      coalesce=coalesce)
   else:
     return core.OneShot(seconds, target=target,
-                        passSelf=pass_self, args=args, kw=kw)
+                        passSelf=pass_self, args=args, kw=kw,
+                        coalesce=coalesce)
 
 
 class NetVis (object):
@@ -188,9 +194,136 @@ def hsv_to_rgb (h, s, v, a = 1):
   return [r,g,b,a]
 
 
+class Trace (object):
+  """
+  The entities a packet has been through, in order
+
+  This reads like a (read-only) list, but it's really an immutable linked
+  list which starts from the most recent entity and points back at the
+  trace before that.  So adding an entity is cheap (see add()), and all
+  the copies of a flooded packet share whatever part of the path they
+  have in common instead of each having a list of their own.
+  """
+  __slots__ = ("_last", "_prev", "_len")
+
+  def __init__ (self, entities = ()):
+    self._last = None
+    self._prev = None
+    self._len = 0
+    for e in entities:
+      # Just building ourselves; nobody has seen us yet
+      self._prev = Trace._node(self._last, self._prev, self._len)
+      self._last = e
+      self._len += 1
+
+  @staticmethod
+  def _node (last, prev, length):
+    t = Trace.__new__(Trace)
+    t._last = last
+    t._prev = prev
+    t._len = length
+    return t
+
+  def add (self, entity):
+    """ Returns a new trace with entity on the end """
+    return Trace._node(entity, self, self._len + 1)
+
+  def __len__ (self):
+    return self._len
+
+  def __iter__ (self):
+    return iter(self._list())
+
+  def __reversed__ (self):
+    t = self
+    while t._len:
+      yield t._last
+      t = t._prev
+
+  def _list (self):
+    l = list(reversed(self))
+    l.reverse()
+    return l
+
+  def __getitem__ (self, index):
+    if index == -1 and self._len:
+      return self._last
+    return self._list()[index]
+
+  def __contains__ (self, entity):
+    return any(e is entity or e == entity for e in reversed(self))
+
+  def __add__ (self, other):
+    return self._list() + list(other)
+
+  def __radd__ (self, other):
+    return list(other) + self._list()
+
+  def __eq__ (self, other):
+    if isinstance(other, (Trace, list, tuple)):
+      return self._list() == list(other)
+    return NotImplemented
+
+  def __ne__ (self, other):
+    r = self.__eq__(other)
+    return r if r is NotImplemented else not r
+
+  __hash__ = None # Like a list
+
+  def __repr__ (self):
+    return repr(self._list())
+
+
+_empty_trace = Trace()
+
+_color_random = _random.Random()
+
+
+_text = type(u"") # unicode on Python 2, str on Python 3
+
+def _field_size (v):
+  """ Roughly how many bytes a packet field takes (see Packet.get_size()) """
+  if v is None: return 0
+  t = type(v)
+  if t is bool: return 1
+  if t is int: return 4 if -2**31 <= v < 2**31 else 8
+  if t is float: return 8
+  if t is bytes: return len(v) # Including str on Python 2
+  if t is _text: return len(v.encode("utf8"))
+  if isinstance(v, (list, tuple, set, frozenset)):
+    return sum(_field_size(x) for x in v)
+  if isinstance(v, dict):
+    return sum(_field_size(k) + _field_size(x) for k,x in v.items())
+  if isinstance(v, Entity): return 4 # An address
+  if isinstance(v, Packet): return v.get_size() # Encapsulated
+  return 8
+
+
 class Packet (object):
   DEFAULT_TTL = 20
 
+  # Fields which are only ever replaced, never changed in place, so that
+  # the copies made when a packet is sent out of several ports can share
+  # them.  If you want to change one of these on a packet you received,
+  # assign a new value (e.g., packet.outer_color = [1,0,0,1]).
+  _shared_fields = frozenset(["trace", "outer_color", "inner_color"])
+
+  # The colors aren't actually made until something looks at them (which
+  # is usually the GUI), so runs without one don't pay for them.  Until
+  # then, a packet's colors come from these.  A default outer color of
+  # None means a random one.
+  _default_outer_color = None
+  _default_inner_color = (0,0,0,0) # transparent
+
+  # How many bytes the packet takes on the wire (see get_size()).  A
+  # subclass can set SIZE to declare a fixed size.
+  SIZE = None
+  HEADER_SIZE = 20 # For src, dst, ttl and so on
+
+  # Fields which are covered by HEADER_SIZE (or aren't really sent)
+  _header_fields = frozenset(["src", "dst", "ttl", "trace", "outer_color",
+                              "inner_color"])
+
   def __init__ (self, dst=NullAddress, src=NullAddress):
     """
     Base class for all packets
@@ -207,13 +340,52 @@ class Packet (object):
     self.src = src
     self.dst = dst
     self.ttl = self.DEFAULT_TTL # Decremented for each entity we go through.
-    self.trace = [] # List of entities we've been sent through.  For debugging.
+    self.trace = _empty_trace # Entities we've been sent through (see Trace)
 
-    # When using NetVis, packets are visible, and you can set the color.
+    # When using NetVis, packets are visible, and you can set the color
+    # (outer_color and inner_color -- see __getattr__() for the defaults).
     # color is a list of red, green, blue, and (optionally) alpha values.
     # Each value is between 0 and 1.  alpha of 0 is transparent.  1 is opaque.
-    self.outer_color = hsv_to_rgb(rand(), rand()*.8+.2, rand()*.5+.5,.75)
-    self.inner_color = [0,0,0,0] # transparent
+
+  def __getattr__ (self, name):
+    """
+    Makes up the colors the first time they're needed
+    """
+    # (This is only called for attributes which haven't been set.)
+    if name == "outer_color":
+      c = self._default_outer_color
+      if c is None:
+        # Colors don't affect the simulation, so they don't use up numbers
+        # from the main random number generator
+        r = _color_random.random
+        c = hsv_to_rgb(r(), r()*.8+.2, r()*.5+.5,.75)
+      else:
+        c = list(c)
+    elif name == "inner_color":
+      c = list(self._default_inner_color)
+    else:
+      raise AttributeError("'%s' object has no attribute '%s'"
+                           % (type(self).__name__, name))
+    self.__dict__[name] = c
+    return c
+
+  def get_size (self):
+    """
+    Returns the size of the packet in bytes
+
+    That's SIZE if the class declares one.  Otherwise, it's HEADER_SIZE
+    plus a rough estimate for each of the packet's own fields: 4 bytes for
+    an address or an int, 8 for a float, the encoded length of a string,
+    and the sum of the contents of a container.  Override this for a
+    different model.
+    """
+    if self.SIZE is not None: return self.SIZE
+    size = self.HEADER_SIZE
+    header = self._header_fields
+    for k,v in self.__dict__.items():
+      if k not in header:
+        size += _field_size(v)
+    return size
 
   def _notify_rx (self, srcEnt, srcPort, dstEnt, dstPort, drop):
     """
@@ -221,7 +393,10 @@ class Packet (object):
 
     Meant for internal use.
     """
-    if not drop: self.trace.append(dstEnt)
+    if drop: return
+    trace = self.trace
+    if type(trace) is not Trace: trace = Trace(trace) # Someone replaced it
+    self.trace = trace.add(dstEnt)
 
   def _notify_tx (self, srcEnt, srcPort, dstEnt, dstPort, drop):
     """
@@ -369,3 +544,67 @@ class HostEntity (Entity):
   """
   pass
 
+
+class TestTrace (unittest.TestCase):
+  """ Checks that Trace acts like the list it used to be """
+  def test_add (self):
+    t = Trace(["a", "b"])
+    u = t.add("c")
+    self.assertEqual(t, ["a", "b"]) # Unchanged
+    self.assertEqual(u, ["a", "b", "c"])
+    self.assertIs(u._prev, t) # Shares what came before
+
+  def test_list (self):
+    t = Trace().add("a").add("b").add("c")
+    self.assertEqual(len(t), 3)
+    self.assertEqual(len(Trace()), 0)
+    self.assertEqual(list(t), ["a", "b", "c"])
+    self.assertEqual(list(reversed(t)), ["c", "b", "a"])
+    self.assertEqual(t[0], "a")
+    self.assertEqual(t[-1], "c")
+    self.assertEqual(t[-2], "b")
+    self.assertEqual(t[1:], ["b", "c"])
+    self.assertRaises(IndexError, lambda: Trace()[-1])
+    self.assertTrue("b" in t)
+    self.assertFalse("d" in t)
+    self.assertEqual(repr(t), repr(["a", "b", "c"]))
+
+  def test_add_lists (self):
+    t = Trace(["b", "c"])
+    self.assertEqual(["a"] + t, ["a", "b", "c"])
+    self.assertEqual(t + ["d"], ["b", "c", "d"])
+    self.assertEqual(t + t, ["b", "c", "b", "c"])
+    self.assertIs(type(["a"] + t), list)
+
+  def test_equality (self):
+    t = Trace(["a", "b"])
+    self.assertEqual(t, ("a", "b"))
+    self.assertEqual(t, Trace().add("a").add("b"))
+    self.assertNotEqual(t, ["a"])
+    self.assertNotEqual(t, ["b", "a"])
+    self.assertNotEqual(t, "ab")
+    self.assertRaises(TypeError, hash, t)
+
+  def test_packets (self):
+    """ Copies of a packet share a trace, and replaced ones still work """
+    p = Packet()
+    self.assertEqual(p.trace, [])
+    p._notify_rx(None, 0, "a", 0, False)
+    q = core._duplicate_packet(p)
+    p._notify_rx(None, 0, "b", 0, False)
+    q._notify_rx(None, 0, "c", 0, False)
+    p._notify_rx(None, 0, "x", 0, True) # Dropped
+    self.assertEqual(p.trace, ["a", "b"])
+    self.assertEqual(q.trace, ["a", "c"])
+    q.trace = q.trace + ["d"]
+    q._notify_rx(None, 0, "e", 0, False)
+    self.assertEqual(q.trace, ["a", "c", "d", "e"])
+
+
+class TestFieldSize (unittest.TestCase):
+  """ Checks the packet size estimates for strings """
+  def test_strings (self):
+    self.assertEqual(_field_size(u"h\xe9llo"), 6) # Encoded as UTF-8
+    self.assertEqual(_field_size(b"h\xc3\xa9llo"), 6)
+    self.assertEqual(_field_size("hello"), 5)
+    self.assertEqual(_field_size([u"ab", b"cd"]), 4)
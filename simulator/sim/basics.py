@@ -100,20 +100,18 @@ class HostDiscoveryPacket (api.Packet):
   """
   Just a way that hosts say hello
   """
-  def __init__ (self, *args, **kw):
-    # Call original constructor
-    super(HostDiscoveryPacket, self).__init__(*args, **kw)
-    self.outer_color = [1,1,0,1]
-    self.inner_color = [1,1,0.5,0.5]
+  _default_outer_color = (1,1,0,1)
+  _default_inner_color = (1,1,0.5,0.5)
 
 
 class RoutePacket (api.Packet):
+  _default_outer_color = (1,0,1,1)
+  _default_inner_color = (1,0,1,1)
+
   def __init__ (self, destination, latency):
     super(RoutePacket,self).__init__()
     self.latency = latency
     self.destination = destination
-    self.outer_color = [1,0,1,1]
-    self.inner_color = [1,0,1,1]
 
   def __repr__ (self):
     return "<RoutePacket to %s at cost %s>" % (self.destination, self.latency)
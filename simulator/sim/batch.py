@@ -0,0 +1,197 @@
+"""
+Headless batch runs
+
+With boot's --batch option, the simulator doesn't wait for NetVis or start
+a console.  It runs in virtual time until --until=T, or -- without that --
+until things are quiet: either there's nothing left to do, or (if the
+cs168.dv module is in use) routing has converged.  Routing counts as
+converged from the start if no routing table has changed for the quiet
+period.  Runs without --until that don't go quiet stop after LIMIT
+simulated seconds anyway.  Then it writes a JSON report on the run to
+--report=FILE (or to stdout).
+
+The report has the number of events dispatched, how long the run took
+(wall clock and simulated), why it stopped, how many packets (and bytes)
+of each type were sent and dropped, and -- for distance vector runs -- when routing
+converged.  The reason is "time" if it got to --until and "limit" if it
+got to LIMIT.  For example:
+
+  ./simulator.py --batch --until=100 --report=run.json topos.rand ...
+
+Scenarios which keep changing things after routing first converges
+(failing links from a tasklet, say) want --until, since otherwise the
+run stops at the first convergence.  Parallel runs (--parallel=N) don't
+stop on convergence, so they generally want --until too.
+"""
+
+from __future__ import print_function
+import sys
+import time
+import json
+
+import sim
+import sim.core as core
+from sim.core import simlog
+import sim.comm as comm
+
+
+LIMIT = 3600.0 # How long (simulated) a run can go without --until
+
+
+class BatchInterface (comm.NullInterface):
+  """ Doesn't talk to anyone, but counts packets """
+  def __init__ (self):
+    self.packets = {} # Packet type name -> count
+    self.bytes = {} # Packet type name -> bytes sent (see Packet.get_size())
+    self.drops = {}
+
+  def packet (self, n1, n2, packet, duration, drop=False):
+    name = type(packet).__name__
+    if drop:
+      self.drops[name] = self.drops.get(name, 0) + 1
+    else:
+      self.packets[name] = self.packets.get(name, 0) + 1
+      self.bytes[name] = self.bytes.get(name, 0) + packet.get_size()
+
+
+interface = BatchInterface
+
+
+def _dv ():
+  """ The cs168.dv module if something has loaded it """
+  return sys.modules.get("cs168.dv")
+
+
+def _collect ():
+  """ The counts for this process """
+  r = dict(packets=dict(getattr(core.events, "packets", {})),
+           bytes=dict(getattr(core.events, "bytes", {})),
+           drops=dict(getattr(core.events, "drops", {})))
+  dv = _dv()
+  if dv:
+    c = dv.convergence
+    r['convergence'] = dict(converged_at=c.converged_at, changes=c.changes)
+  return r
+
+
+def _collect_worker ():
+  """ What each worker reports back in a parallel run """
+  r = _collect()
+  r['pending'] = core.world._next_event() is not None
+  if 'convergence' in r:
+    r['convergence']['last_change'] = _dv().convergence.last_change
+  return r
+
+
+def _merge_counts (into, counts):
+  for k,v in counts.items():
+    into[k] = into.get(k, 0) + v
+
+
+def _never_changed (c, start):
+  """ Whether routing has been quiet since start without any changes """
+  return c.last_change is None and core.world.time - start >= c.quiet_period
+
+
+def _run_serial (until, limit):
+  world = core.world
+  start = world.time
+  predicate = None
+  dv = _dv()
+  if until is None and dv:
+    c = dv.convergence
+    predicate = lambda: c.converged or _never_changed(c, start)
+  end = until
+  if end is None and limit is not None:
+    end = start + limit
+  try:
+    reason,count = world._run_until(end, predicate, True, None)
+  except SystemExit as e:
+    reason,count = "stopped", getattr(e, "events", 0)
+  finally:
+    world._dump_trace()
+  if reason == "predicate": reason = "converged"
+  if reason == "time" and until is None: reason = "limit"
+  world._running = False
+  r = _collect()
+  r.update(reason=reason, events=count)
+  if reason == "converged" and r['convergence']['converged_at'] is None:
+    r['convergence']['converged_at'] = start # Nothing ever changed
+  return r
+
+
+def _run_parallel (workers, until, limit):
+  import sim.pdes
+  start = core.world.time
+  end = until
+  if end is None and limit is not None:
+    end = start + limit
+  results = sim.pdes.run(workers, until=end, collect=_collect_worker)
+  r = dict(events=0, packets={}, bytes={}, drops={},
+           partitions=len(results))
+  for result in results:
+    r['events'] += result['events']
+    _merge_counts(r['packets'], result['packets'])
+    _merge_counts(r['bytes'], result['bytes'])
+    _merge_counts(r['drops'], result['drops'])
+  if not any(result['pending'] for result in results):
+    r['reason'] = "idle"
+  elif end is not None:
+    r['reason'] = "time" if until is not None else "limit"
+    core.world._time = end
+  else:
+    r['reason'] = "stopped"
+  if 'convergence' in results[0]:
+    # A worker can't tell when advertisements it sent to another partition
+    # arrive, so workers don't reliably notice convergence themselves.
+    # Instead, say it converged at the last change anywhere if it has
+    # been quiet for long enough since then.
+    dv = _dv()
+    cs = [result['convergence'] for result in results]
+    last = [c['last_change'] for c in cs if c['last_change'] is not None]
+    last = max(last) if last else None
+    if last is not None:
+      if core.world.time - last < dv.convergence.quiet_period: last = None
+    elif core.world.time - start >= dv.convergence.quiet_period:
+      last = start # Nothing ever changed
+    r['convergence'] = dict(converged_at=last,
+                            changes=sum(c['changes'] for c in cs))
+  return r
+
+
+def run (until = None, report = None, workers = 1, limit = LIMIT):
+  """
+  Runs the (not yet started) world and writes the report
+
+  report is a filename, or None for stdout.  limit is how long to run if
+  until isn't set and things don't go quiet (None for no limit).  Returns
+  the report as a dict.
+  """
+  world = core.world
+  start = time.time()
+  start_time = world.time
+  if workers > 1:
+    r = _run_parallel(workers, until, limit)
+  else:
+    r = _run_serial(until, limit)
+  wall = time.time() - start
+
+  r['wall_time'] = wall
+  r['sim_time'] = world.time - start_time
+  r['events_per_second'] = r['events'] / wall if wall > 0 else None
+  r['total_packets'] = sum(r['packets'].values())
+  r['total_bytes'] = sum(r['bytes'].values())
+  r['total_drops'] = sum(r['drops'].values())
+  if 'convergence' in r and r['convergence']['converged_at'] is not None:
+    # Relative to the start of the run, like sim_time
+    r['convergence']['converged_at'] -= start_time
+
+  text = json.dumps(r, indent=2, sort_keys=True)
+  if report is None:
+    sys.stdout.write(text + "\n")
+    sys.stdout.flush()
+  else:
+    with open(report, "w") as f:
+      f.write(text + "\n")
+    simlog.info("Wrote report to %s", report)
+  return r
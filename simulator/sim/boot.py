@@ -114,6 +114,13 @@ def main ():
     _monkeypatch_console()
     interp = code.InteractiveConsole(locals=variables)
     interp.interact("")
+  elif sim.config.batch:
+    import sim.batch
+    sim.batch.run(sim.config.until, sim.config.report_file,
+                  sim.config.parallel)
+  elif sim.config.parallel > 1:
+    import sim.pdes
+    sim.pdes.run(sim.config.parallel)
   else:
     # Non-interactive always starts automatically
     import sim.core as core
@@ -124,8 +131,12 @@ def pre_options (default_host_type = None, default_switch_type = None,
                  gui_log = False, console_log = True, debug_startup = True,
                  remote_interface = "web", remote_interface_port = 4444,
                  remote_interface_address = "127.0.0.1", interactive = True,
-                 very_quiet = False, readline = True,
-                 **kw):
+                 very_quiet = False, readline = True, virtual_time = False,
+                 parallel = 1, time_scale = 1, trace_file = None,
+                 trace_size = 65536, profile = False, record = None,
+                 seed = None, replay = None, stats_info = False,
+                 batch = False, until = None, report = None,
+                 asyncio = False, **kw):
   """
   Set up initial options and create world
 
@@ -138,7 +149,6 @@ def pre_options (default_host_type = None, default_switch_type = None,
     class Dummy (object):
       def write (self, *args, **kw):
         pass
-    import sys
     sys.stdout = Dummy()
     sys.stderr = Dummy()
 
@@ -147,6 +157,47 @@ def pre_options (default_host_type = None, default_switch_type = None,
   sim.config.debug_startup = debug_startup
   sim.config.interactive = interactive
   sim.config.readline = readline
+  sim.config.virtual_time = virtual_time
+  sim.config.time_scale = float(time_scale)
+  if sim.config.time_scale <= 0:
+    _fail("--time-scale must be positive")
+    sys.exit(1)
+  sim.config.stats_info = bool(stats_info)
+  sim.config.trace_file = trace_file
+  sim.config.trace_size = int(trace_size)
+  if profile:
+    # --profile writes profile.json; --profile=FILE writes somewhere else
+    sim.config.profile = True
+    sim.config.profile_file = "profile.json" if profile is True else profile
+  if record and replay:
+    _fail("Can't --record and --replay at the same time")
+    sys.exit(1)
+  sim.config.record_file = record
+  sim.config.record_seed = None if seed is None else int(seed)
+  sim.config.replay_file = replay
+  if replay:
+    # Replays run as fast as possible
+    sim.config.virtual_time = True
+  sim.config.batch = bool(batch)
+  sim.config.until = None if until is None else float(until)
+  sim.config.report_file = report
+  if batch:
+    # Headless: no console or GUI, and as fast as possible
+    interactive = False
+    sim.config.interactive = False
+    sim.config.virtual_time = True
+    remote_interface = "batch"
+  elif until is not None or report is not None:
+    _fail("--until and --report only work with --batch")
+    sys.exit(1)
+  sim.config.asyncio = bool(asyncio)
+  sim.config.parallel = int(parallel)
+  if sim.config.parallel > 1:
+    if interactive:
+      _fail("--parallel only works with --no-interactive")
+      sys.exit(1)
+    # Parallel runs are always in virtual time
+    sim.config.virtual_time = True
 
   sim.config.default_host_type = default_host_type
   sim.config.default_switch_type = default_switch_type
@@ -155,7 +206,8 @@ def pre_options (default_host_type = None, default_switch_type = None,
   sim.config.remote_interface_port = int(remote_interface_port)
   sim.config.remote_interface_address = remote_interface_address
 
-  print(_console_welcome)
+  if not batch:
+    print(_console_welcome)
 
   import sim.core as core
   global w
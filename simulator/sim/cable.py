@@ -3,6 +3,7 @@ Cables are how Entities are connected
 """
 
 import random
+from collections import deque
 import sim.core as core
 
 class Cable (object):
@@ -74,35 +75,60 @@ class BasicCable (DumbCable):
   """
   DEFAULT_QUEUE_SIZE = None # Unlimited
   DEFAULT_TX_TIME = 0.1 # Transmission delay
+  DEFAULT_BANDWIDTH = None # Bytes per second (None uses tx_time instead)
+  CHECK_QUEUE = False # Check that the queue is in order (slow; debugging)
 
   def __init__ (self, *args, **kw):
+    """
+    Takes latency, plus queue_size, tx_time and bandwidth
+
+    If bandwidth is set, a packet's transmission delay is its size (see
+    Packet.get_size()) divided by the bandwidth.  Otherwise, every packet
+    takes tx_time.
+    """
     self.size = kw.pop("queue_size", self.DEFAULT_QUEUE_SIZE)
-    self.queue = [] # time, packet
-    self.next_delivery = None
+    self.tx_time = kw.pop("tx_time", self.DEFAULT_TX_TIME)
+    self.bandwidth = kw.pop("bandwidth", self.DEFAULT_BANDWIDTH)
+    self.queue = deque() # (delivery time, packet), in order of time
+    self.next_delivery = None # When our pending deliver() event is for
+    self._delivery = None # That event
 
-    super(BasicCable, self).__init__(*args, **kw)
+    # What's been put on the wire (not counting packets dropped because the
+    # queue was full, which are counted in dropped)
+    self.tx_packets = 0
+    self.tx_bytes = 0
+    self.dropped = 0
 
-    self.tx_time = kw.pop("tx_time", self.DEFAULT_TX_TIME)
+    super(BasicCable, self).__init__(*args, **kw)
 
     self._tx_stop = None # Time at which current transfer ends (or None)
 
   def drop (self):
-    del self.queue[-1] # Tail drop
+    """ Drops the packet at the end of the queue (because it's full) """
+    self.dropped += 1
+    packet = self.queue.pop()[1]
+    core.events.packet(self.srcEnt.name, self.dstEnt.name, packet,
+                       self.latency, drop=True)
 
   def sched (self):
     if not self.queue: return
-    assert [x[0] for x in self.queue] == [x[0] for x in sorted(self.queue, key=self._queue_key)]
-    #self.queue.sort() # We could do better than this! (And have, apparently)
+    if self.CHECK_QUEUE:
+      times = [x[0] for x in self.queue]
+      assert times == sorted(times), "Cable queue out of order"
+    # There's only ever one deliver() event, for the head of the queue
+    # (which delivers everything that's due by then).  We only need a new
+    # one if there isn't one or the head is now due sooner.
     t = self.queue[0][0]
-    self.next_delivery = None
     if self.next_delivery is None or t < self.next_delivery:
+      core.world.cancel(self._delivery)
       self.next_delivery = t
-      core.world.doAt(t, self.deliver)
+      self._delivery = core.world._schedule(t, self.deliver)
 
   def deliver (self):
     if self.src: self.old_src = self.src
     if self.dst: self.old_dst = self.dst
     self.next_delivery = None
+    self._delivery = None
     drop = False
     if not self.src or self.src.ports[self.srcPort] is not self:
       if self.queue:
@@ -112,18 +138,28 @@ class BasicCable (DumbCable):
 
     while self.queue:
       if self.queue[0][0] > core.world.time: break
-      p = self.queue.pop(0)[1]
+      p = self.queue.popleft()[1]
       self._do_deliver(p, drop)
     self.sched()
 
   def _do_deliver (self, p, drop):
     p._notify_rx(self.srcEnt, self.srcPort, self.dstEnt, self.dstPort, drop)
     if not drop:
-      self.dstEnt.handle_rx(p, self.dstPort)
+      profiler = core.world.profiler
+      if profiler is not None:
+        # Count it for the receiver rather than for deliver()
+        profiler.call(self.dstEnt.handle_rx, (p, self.dstPort))
+      else:
+        self.dstEnt.handle_rx(p, self.dstPort)
 
   def transfer (self, packet):
     now = core.world.time
-    tx_time = self.tx_time
+    size = packet.get_size()
+    if self.bandwidth:
+      tx_time = size / float(self.bandwidth)
+    else:
+      tx_time = self.tx_time
+    tx_stop = self._tx_stop
     if self._tx_stop is None or now >= self._tx_stop:
       # Not transferring
       tx_at = now
@@ -133,16 +169,21 @@ class BasicCable (DumbCable):
       tx_at = self._tx_stop
       self._tx_stop += tx_time
 
-    self.queue.append((tx_at + tx_time + self.latency,packet))
-    if self.size is not None and len(self.queue) > self.size:
-      self.drop()
-
-    if len(self.queue) >= 2:
-      if self.queue[-1][0] < self.queue[-2][0]:
-        # Deliver last before second-to-last?
-        # Simple answer: just sort
-        self.queue.sort(key=self._queue_key)
-
+    # Packets go out one after another, so they arrive in order too --
+    # unless the latency was just lowered, in which case this one still
+    # can't pass the ones ahead of it.  Either way, the queue stays sorted.
+    t = tx_at + tx_time + self.latency
+    queue = self.queue
+    if queue and t < queue[-1][0]:
+      t = queue[-1][0]
+    queue.append((t, packet))
+    if self.size is not None and len(queue) > self.size:
+      self.drop() # That's this packet, so that's it for it
+      self._tx_stop = tx_stop # ...and it never actually goes out
+      return
+
+    self.tx_packets += 1
+    self.tx_bytes += size
     self.sched()
 
     core.events.packet(self.srcEnt.name, self.dstEnt.name, packet, self.latency)
@@ -150,11 +191,7 @@ class BasicCable (DumbCable):
     packet._notify_tx(self.srcEnt, self.srcPort, self.dstEnt, self.dstPort, False)
 
   def _handle_disconnect (self):
-    del self.queue[:]
-
-  @staticmethod
-  def _queue_key (queue_item):
-    return queue_item[0]
+    self.queue.clear()
 
 
 class UnreliableCable (BasicCable):
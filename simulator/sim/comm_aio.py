@@ -0,0 +1,225 @@
+"""
+The TCP and web remote interfaces, served with asyncio streams
+
+These speak the same protocols as comm_tcp and comm_web, but instead of a
+listener thread and a thread per connection, everything happens on the
+event loop the world runs on (see sim.aio).  They're used in place of
+those when the simulator is started with --asyncio, and the servers
+start when the world does.
+"""
+
+import sim
+import struct
+import base64
+import hashlib
+import asyncio
+import mimetypes
+import os
+
+from sim.core import _get_ident
+from .comm_tcp import StreamingConnection, StreamingInterface
+from . import comm_web
+
+log = comm_web.log
+
+
+class Connection (StreamingConnection):
+  """ A newline-delimited JSON connection (like comm_tcp's) """
+  def __init__ (self, parent, reader, writer):
+    self.parent = parent
+    self.reader = reader
+    self.writer = writer
+    self.sock = writer # So it looks connected
+
+  async def serve (self):
+    self.parent.connections.append(self)
+    self._send_initialize()
+    try:
+      while True:
+        l = await self.reader.readline()
+        if not l: break
+        self._process_incoming(l)
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    self.parent._disconnect(self)
+
+  def _write (self, data):
+    """ Writes raw bytes (from whatever thread) """
+    if self.writer.is_closing(): raise RuntimeError("Connection closed")
+    if _get_ident() == self.parent._ident:
+      self.writer.write(data)
+    else:
+      self.parent.loop.call_soon_threadsafe(self.writer.write, data)
+
+  def send_raw (self, msg):
+    self._write(msg.encode())
+
+  def _close (self):
+    self.writer.close()
+
+
+class WebConnection (Connection):
+  """
+  An HTTP connection which serves NetVis or upgrades to a websocket
+  """
+  WS_CONTINUE = comm_web.WebHandler.WS_CONTINUE
+  WS_TEXT = comm_web.WebHandler.WS_TEXT
+  WS_BINARY = comm_web.WebHandler.WS_BINARY
+  WS_CLOSE = comm_web.WebHandler.WS_CLOSE
+  WS_PING = comm_web.WebHandler.WS_PING
+  WS_PONG = comm_web.WebHandler.WS_PONG
+
+  _frame = staticmethod(comm_web.WebHandler._frame)
+  _get_base_path = comm_web.WebHandler._get_base_path
+  translate_path = comm_web.WebHandler.translate_path
+
+  async def serve (self):
+    try:
+      while True:
+        request = await self.reader.readline()
+        if not request: break
+        headers = {}
+        while True:
+          l = (await self.reader.readline()).decode("latin-1").strip()
+          if not l: break
+          k,v = l.split(":", 1)
+          headers[k.strip().lower()] = v.strip()
+        parts = request.decode("latin-1").split()
+        if len(parts) < 2 or parts[0] != "GET":
+          self._respond(405, "Method Not Allowed")
+          break
+        if headers.get("upgrade", "").lower() == "websocket":
+          await self._serve_websocket(headers)
+          break
+        self._serve_file(parts[1])
+        if headers.get("connection", "").lower() == "close": break
+    except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+      pass
+    self.parent._disconnect(self)
+
+  def _respond (self, code, message, headers = {}, body = b""):
+    out = ["HTTP/1.1 %s %s" % (code, message)]
+    headers = dict(headers)
+    if code != 101:
+      headers.setdefault("Content-Length", str(len(body)))
+    out += ["%s: %s" % kv for kv in headers.items()]
+    self.writer.write(("\r\n".join(out) + "\r\n\r\n").encode() + body)
+
+  def _serve_file (self, path):
+    fn = self.translate_path(path)
+    if os.path.isdir(fn):
+      fn = os.path.join(fn, "index.html")
+    try:
+      with open(fn, "rb") as f:
+        body = f.read()
+    except IOError:
+      log.debug("GET %s 404", path)
+      self._respond(404, "Not Found")
+      return
+    log.debug("GET %s 200", path)
+    kind = mimetypes.guess_type(fn)[0] or "application/octet-stream"
+    self._respond(200, "OK", {"Content-Type":kind}, body)
+
+  async def _serve_websocket (self, headers):
+    log.debug("Upgrading to websocket")
+    k = headers.get("sec-websocket-key", "")
+    k += "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    k = base64.b64encode(hashlib.sha1(k.encode("UTF-8")).digest())
+    self._respond(101, "Switching Protocols",
+                  {"Sec-WebSocket-Accept":k.decode("UTF-8"),
+                   "Upgrade":"websocket", "Connection":"Upgrade"})
+    self.parent.connections.append(self)
+    self._send_initialize()
+
+    data = b''
+    old_op = None
+    while True:
+      flags_op,len1 = struct.unpack("!BB", await self.reader.readexactly(2))
+      op = flags_op & 0x0f
+      fin = flags_op & 0x80
+      if (len1 & 0x80) == 0: raise ValueError("No mask set")
+      length = len1 & 0x7f
+      if length == 0x7e:
+        length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+      elif length == 0x7f:
+        length = struct.unpack("!Q", await self.reader.readexactly(8))[0]
+      mask = await self.reader.readexactly(4)
+      d = await self.reader.readexactly(length)
+      d = bytes(c ^ mask[i % 4] for i,c in enumerate(d))
+
+      if not fin:
+        if op == self.WS_CONTINUE:
+          if old_op is None: raise ValueError("Continuing unknown opcode")
+        else:
+          if old_op is not None: raise ValueError("Discarded partial message")
+          old_op = op
+        data += d
+        continue
+      if op == self.WS_CONTINUE:
+        if old_op is None: raise ValueError("Can't continue unknown frame")
+        op = old_op
+      d = data + d
+      old_op = None
+      data = b''
+
+      if op in (self.WS_TEXT, self.WS_BINARY):
+        self._process_incoming(d)
+      elif op == self.WS_PING:
+        self._write(self._frame(self.WS_PONG, d))
+      elif op == self.WS_CLOSE:
+        break
+
+  def send_raw (self, msg):
+    self._write(self._frame(self.WS_TEXT, msg.encode()))
+
+
+class TCPInterface (StreamingInterface):
+  """ Like comm_tcp's interface """
+  CONNECTION_CLASS = Connection
+
+  def __init__ (self):
+    self.connections = []
+    self.server = None
+    self.loop = None
+    self._ident = None
+
+  async def serve (self):
+    """ Starts listening (called by sim.aio.run()) """
+    self.loop = asyncio.get_running_loop()
+    self._ident = _get_ident()
+    self.server = await asyncio.start_server(self._accept,
+        sim.config.remote_interface_address,
+        sim.config.remote_interface_port, reuse_address=True)
+    self._announce(*self.server.sockets[0].getsockname()[:2])
+
+  def _announce (self, address, port):
+    log.info("Listening at %s:%s", address, port)
+
+  async def close (self):
+    if self.server is None: return
+    self.server.close()
+    for c in list(self.connections):
+      self._disconnect(c)
+    await self.server.wait_closed()
+    self.server = None
+
+  async def _accept (self, reader, writer):
+    await self.CONNECTION_CLASS(self, reader, writer).serve()
+
+  def send (self, msg, connections = None):
+    if self.loop is None: return # Not serving yet
+    StreamingInterface.send(self, msg, connections)
+
+
+class WebInterface (TCPInterface):
+  """ Like comm_web's interface """
+  CONNECTION_CLASS = WebConnection
+
+  def _announce (self, address, port):
+    log.info("Webserver running at http://%s:%s", address, port)
+
+
+def interface ():
+  if sim.config.remote_interface == "web":
+    return WebInterface()
+  return TCPInterface()
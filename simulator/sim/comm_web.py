@@ -491,7 +491,7 @@ class WebInterface (ThreadingMixIn, HTTPServer):
       "type":"packet",
       "node1":n1,
       "node2":n2,
-      "duration":duration * 1000,
+      "duration":duration * 1000 / core.world.time_scale,
       "stroke":packet.outer_color,
       "fill":packet.inner_color,
       "drop":drop,
@@ -11,15 +11,20 @@ import sys
 import sim
 import copy
 import threading
-try:
-  import queue as Queue
-except ImportError:
-  import Queue
 import time
 import weakref
+import heapq
+import itertools
+from collections import deque
+try:
+  from threading import get_ident as _get_ident
+except ImportError:
+  from thread import get_ident as _get_ident
 
 import logging
 import traceback
+import math
+import unittest
 
 class EventLogger (logging.Handler):
   _attributes = [
@@ -103,49 +108,705 @@ def _catch (_f, *_args, **_kw):
 class Timer (object):
   """ It's a timer.
   You should just create this with api.create_timer()."""
-  def __init__ (self, seconds, target=None, args=(), kw={}, passSelf=False):
+  def __init__ (self, seconds, target=None, args=(), kw={}, passSelf=False,
+                coalesce=False):
     self.seconds = seconds
-    world.doLater(seconds, self.timeout)
     self.func = target
     self.stopped = False
     self.args = list(args)
     self.kw = dict(kw)
     if passSelf:
       self.args = [self] + self.args
+    self._batch = None # TimerBatch we're in, if any
+    self._event = None
+    if coalesce:
+      world.doTimerBatchLater(seconds, self)
+    else:
+      self._event = world._schedule_timer(seconds, self.timeout)
 
   def cancel (self):
+    if self.stopped: return
     self.stopped = True
+    if self._batch is not None:
+      self._batch._discard()
+      self._batch = None
+    else:
+      world.cancel(self._event)
+    self._event = None
 
   def timer (self):
     if self.func:
       self.func(*self.args,**self.kw)
 
   def timeout (self):
-    if self.stopped: return
+    self._event = None
+    if self._expire():
+      self._event = world._schedule_timer(self.seconds, self.timeout)
+
+  def _expire (self):
+    """ Runs the timer and returns whether it should go off again """
+    if self.stopped: return False
     try:
-      rv = self.timer()
-      if rv is not False:
-        world.doLater(self.seconds, self.timeout)
+      return self.timer() is not False and not self.stopped
     except Exception:
       simlog.exception("Exception while executing a timer")
       #traceback.print_exc()
+      return False
 
 
 class OneShot (Timer):
   """ It's a single-shot timer.
   You should just create this with api.create_timer()."""
-  def timeout (self):
-    if self.stopped: return
+  def _expire (self):
+    if self.stopped: return False
     try:
       self.timer()
     except Exception:
       simlog.exception("Exception while executing a one-shot timer")
       #traceback.print_exc()
+    return False
+
+
+class TimerBatch (object):
+  """
+  A bunch of timers which go off together
+
+  Timers created with coalesce=True don't get their own events.  Instead,
+  ones with the same period whose deadlines are within WINDOW seconds of
+  each other share a single event which runs them all (in the order they
+  joined).  Recurring ones stay in the batch for the next round.
+  """
+  WINDOW = 0.01
+
+  def __init__ (self, seconds):
+    self.seconds = seconds
+    self.timers = []
+    self.live = 0 # How many of the timers aren't stopped
+    self.time = None
+    self.key = None
+    self._event = None
+
+  @classmethod
+  def add (cls, seconds, timer):
+    """ Puts timer in a batch which is due in (about) seconds """
+    t = world.time + seconds
+    n = int(t // cls.WINDOW)
+    batches = world._timer_batches
+    for k in (n, n - 1, n + 1):
+      batch = batches.get((seconds, k))
+      if batch is not None and abs(batch.time - t) <= cls.WINDOW:
+        break
+    else:
+      batch = cls(seconds)
+      batch._schedule(t)
+    batch.timers.append(timer)
+    batch.live += 1
+    timer._batch = batch
+
+  def _schedule (self, t):
+    self.time = t
+    self.key = (self.seconds, int(t // self.WINDOW))
+    world._timer_batches[self.key] = self
+    self._event = world._real_doTimerAt(t, self.timeout)
+
+  def _unregister (self):
+    # New timers shouldn't join us while we're running or once we're dead
+    if world._timer_batches.get(self.key) is self:
+      del world._timer_batches[self.key]
+
+  def _discard (self):
+    """ Called when one of our timers is cancelled """
+    self.live -= 1
+    if self.live == 0:
+      self._unregister()
+      world.cancel(self._event)
+      self._event = None
+
+  def timeout (self):
+    event = self._event
+    self._unregister()
+    self._event = None
+    tracer = world.tracer
+    profiler = world.profiler
+    timers = []
+    for t in self.timers:
+      if tracer is not None and event is not None:
+        tracer.record(event, t._expire) # Shows which timer it was
+      if profiler is not None:
+        keep = profiler.call(t._expire) # So it's counted as its own
+      else:
+        keep = t._expire()
+      if keep:
+        timers.append(t)
+      elif t._batch is self:
+        t._batch = None # It's done, so cancelling it is none of our business
+    self.timers = timers
+    self.live = len(timers)
+    if self.timers:
+      self._schedule(world.time + self.seconds)
+
+
+class TimingWheel (object):
+  """
+  A hierarchical timing wheel for timer events
+
+  Events are (time, count, ...) tuples just like in the World's queue.
+  Adding one just drops it into a slot, which is O(1) no matter how many
+  timers there are.  Level 0 has a slot per RESOLUTION seconds, and each
+  level above it has slots SLOTS times as wide; things too far out for
+  even the top level wait in a heap off to the side.  Slots get emptied
+  into the level below as the wheel turns, and into a small heap of due
+  events once they reach level 0.  Events keep their exact times, so
+  they come out in precisely the order the queue would have given.
+  """
+  RESOLUTION = 0.05
+  BITS = 7
+  SLOTS = 1 << BITS
+  LEVELS = 4
+
+  def __init__ (self):
+    self._levels = [[[] for _ in range(self.SLOTS)]
+                    for _ in range(self.LEVELS)]
+    self._counts = [0] * self.LEVELS # How many events in each level
+    self._spans = [1 << (self.BITS * (l + 1)) for l in range(self.LEVELS)]
+    self._far = [] # Heap of events beyond the top level
+    self._due = [] # Heap of events in (or before) the current tick
+    self._tick = None # Current position of the wheel (None when empty)
+
+  def __len__ (self):
+    return sum(self._counts) + len(self._far) + len(self._due)
+
+  def __iter__ (self):
+    """ Iterates over all the events (in no particular order) """
+    for slots in self._levels:
+      for slot in slots:
+        for o in slot:
+          yield o
+    for o in self._far:
+      yield o
+    for o in self._due:
+      yield o
+
+  def add (self, o):
+    tick = int(o[0] // self.RESOLUTION)
+    if self._tick is None:
+      self._tick = tick - 1
+    self._place(o, tick)
+
+  def _place (self, o, tick):
+    delta = tick - self._tick
+    if delta <= 0:
+      heapq.heappush(self._due, o)
+      return
+    level = 0
+    for span in self._spans:
+      if delta < span:
+        self._levels[level][(tick >> (self.BITS * level)) & (self.SLOTS-1)].append(o)
+        self._counts[level] += 1
+        return
+      level += 1
+    heapq.heappush(self._far, o)
+
+  def compact (self):
+    """
+    Throws out cancelled events (ones with a method of None)
+
+    Returns how many were removed.
+    """
+    removed = 0
+    for level,slots in enumerate(self._levels):
+      for index,slot in enumerate(slots):
+        if not slot: continue
+        alive = [o for o in slot if o[2] is not None]
+        if len(alive) != len(slot):
+          slots[index] = alive
+          removed += len(slot) - len(alive)
+          self._counts[level] -= len(slot) - len(alive)
+    for attr in ('_due', '_far'):
+      heap = getattr(self, attr)
+      alive = [o for o in heap if o[2] is not None]
+      if len(alive) != len(heap):
+        removed += len(heap) - len(alive)
+        heapq.heapify(alive)
+        setattr(self, attr, alive)
+    return removed
+
+  def peek (self):
+    """ Returns the next event without removing it (or None if empty) """
+    if not self._due:
+      if self._tick is None: return None # Totally empty
+      self._turn()
+      if not self._due: return None
+    return self._due[0]
+
+  def pop (self):
+    """ Removes and returns the next event """
+    if not self._due:
+      self._turn()
+    return heapq.heappop(self._due)
+
+  def _turn (self):
+    """ Turns the wheel until something is due or there's nothing left """
+    bits = self.BITS
+    mask = self.SLOTS - 1
+    resolution = self.RESOLUTION
+    levels = self._levels
+    counts = self._counts
+    while not self._due:
+      # Skip straight past stretches where nothing can possibly be due:
+      # if the lowest n levels are empty, jump to the next level n slot.
+      for lowest in range(self.LEVELS):
+        if counts[lowest]: break
+      else:
+        if not self._far:
+          self._tick = None
+          return
+        # Only far-off stuff left, so just move the wheel up to it
+        far = self._far
+        self._far = []
+        self._tick = int(far[0][0] // resolution) - 1
+        for o in far:
+          self._place(o, int(o[0] // resolution))
+        continue
+      self._tick = (self._tick | ((1 << (bits * lowest)) - 1)) + 1
+      tick = self._tick
+
+      # Which levels just rolled over?
+      top = 0
+      while top < self.LEVELS and not tick & ((1 << (bits * (top + 1))) - 1):
+        top += 1
+
+      if top == self.LEVELS:
+        # Wrapped all the way around; bring in far stuff that now fits
+        top -= 1
+        far = self._far
+        self._far = []
+        for o in far:
+          self._place(o, int(o[0] // resolution))
+
+      # Cascade from the top down...
+      for level in range(top, 0, -1):
+        index = (tick >> (bits * level)) & mask
+        slot = levels[level][index]
+        if not slot: continue
+        levels[level][index] = []
+        counts[level] -= len(slot)
+        for o in slot:
+          self._place(o, int(o[0] // resolution))
+
+      # ...and then everything in the level 0 slot is due now
+      slot = levels[0][tick & mask]
+      if slot:
+        levels[0][tick & mask] = []
+        counts[0] -= len(slot)
+        slot.extend(self._due)
+        heapq.heapify(slot)
+        self._due = slot
+
+
+class _HandlerCache (object):
+  """
+  Remembers something about what each event calls
+
+  make(callable) works out the value the first time.  Events wrapped in
+  _catch() are looked up by the callable they wrap.  Since this holds
+  onto the callables, it starts over once it has SIZE of them so as not to
+  keep old timers and such alive forever.
+  """
+  SIZE = 4096
+
+  def __init__ (self, make):
+    self._make = make
+    self._values = {}
+
+  def get (self, method, args):
+    """ Returns the value for an event's method (and args) """
+    if method is _catch and args:
+      method = args[0]
+    v = self._values.get(method)
+    if v is None:
+      v = self._make(method)
+      if len(self._values) >= self.SIZE:
+        self._values.clear()
+      self._values[method] = v
+    return v
+
+
+class Tracer (object):
+  """
+  Remembers the last few events the World dispatched
+
+  For each event, it records the time, sequence number, what was called,
+  and which entity it was for (if any) into preallocated arrays used as a
+  ring buffer, so it's cheap enough to just leave on.  Callables and
+  entities are stored as small integers; their names are only looked up
+  when dumping.  If filename is set, the World dumps the buffer there when
+  its loop stops.  Each of a TimerBatch's timers gets a record of its own
+  (with the batch's time and sequence number) after the batch's.
+  """
+  MAGIC = b"SIMTRACE1\n"
+
+  def __init__ (self, size = 65536, filename = None):
+    from array import array
+    self.size = size
+    self.filename = filename
+    self.times = array('d', [0.0]) * size
+    try:
+      self.seqs = array('q', [0]) * size
+    except ValueError:
+      self.seqs = array('l', [0]) * size # Python 2 has no 'q'
+    self.calls = array('i', [0]) * size
+    self.targets = array('i', [0]) * size
+    self.count = 0 # Total events recorded (including overwritten ones)
+    self._call_ids = {} # function -> id
+    self._call_names = []
+    self._entity_ids = {} # entity name -> id
+    self._entity_names = []
+    self._cache = _HandlerCache(self._identify)
+
+  def record (self, o, method):
+    """ Records event o (whose method is passed separately) """
+    ids = self._cache.get(method, o[3])
+    i = self.count % self.size
+    self.times[i] = o[0]
+    self.seqs[i] = o[1]
+    self.calls[i], self.targets[i] = ids
+    self.count += 1
+
+  def _identify (self, method):
+    """ Returns (callable id, entity id) for an event's callable """
+    obj = getattr(method, "__self__", None)
+    if isinstance(obj, Timer) and obj.func is not None:
+      # What the timer calls says more than Timer.timeout does
+      method = obj.func
+      obj = getattr(method, "__self__", None)
+    func = getattr(method, "__func__", method)
+
+    cid = self._call_ids.get(func)
+    if cid is None:
+      cid = self._call_ids[func] = len(self._call_names)
+      name = getattr(func, "__qualname__", None) # Not in Python 2
+      if name is None:
+        name = getattr(func, "__name__", None) or str(func)
+        if obj is not None: name = type(obj).__name__ + "." + name
+      self._call_names.append(name)
+
+    # Figure out whose event it is
+    obj = getattr(obj, "entity", obj) # TopoNode
+    obj = getattr(obj, "dstEnt", obj) # Cable
+    name = getattr(obj, "name", None)
+    if name is None:
+      return cid, -1
+    eid = self._entity_ids.get(name)
+    if eid is None:
+      eid = self._entity_ids[name] = len(self._entity_names)
+      self._entity_names.append(name)
+    return cid, eid
+
+  def _order (self):
+    """ Indices of the buffered records from oldest to newest """
+    if self.count <= self.size:
+      return list(range(self.count))
+    start = self.count % self.size
+    return list(range(start, self.size)) + list(range(start))
+
+  def records (self):
+    """
+    Returns the buffered records, oldest first
+
+    Each is a (time, sequence number, callable name, entity name) tuple.
+    The entity name is None for events that aren't for an entity.
+    """
+    calls = self._call_names
+    entities = self._entity_names
+    return [(self.times[i], self.seqs[i], calls[self.calls[i]],
+             entities[self.targets[i]] if self.targets[i] >= 0 else None)
+            for i in self._order()]
+
+  def dump (self, filename = None):
+    """
+    Writes the buffered records to a file (see load())
+
+    The file is a header line with the name tables as JSON followed by
+    the raw arrays, oldest record first.
+    """
+    import json
+    from array import array
+    if filename is None: filename = self.filename
+    order = self._order()
+    arrays = (self.times, self.seqs, self.calls, self.targets)
+    header = dict(count=len(order), total=self.count, byteorder=sys.byteorder,
+                  typecodes="".join(a.typecode for a in arrays),
+                  calls=self._call_names, entities=self._entity_names)
+    with open(filename, "wb") as f:
+      f.write(self.MAGIC)
+      f.write(json.dumps(header).encode("utf8") + b"\n")
+      for a in arrays:
+        array(a.typecode, [a[i] for i in order]).tofile(f)
+
+  @classmethod
+  def load (cls, filename):
+    """ Reads a dump, returning records like records() does """
+    import json
+    from array import array
+    with open(filename, "rb") as f:
+      if f.readline() != cls.MAGIC:
+        raise RuntimeError("%s is not a trace file" % (filename,))
+      header = json.loads(f.readline().decode("utf8"))
+      arrays = []
+      for typecode in header['typecodes']:
+        try:
+          a = array(str(typecode))
+        except ValueError:
+          a = array('l') # A 'q' from Python 3, but we're on Python 2
+        a.fromfile(f, header['count'])
+        if header['byteorder'] != sys.byteorder: a.byteswap()
+        arrays.append(a)
+    calls = header['calls']
+    entities = header['entities']
+    return [(t, seq, calls[c], entities[e] if e >= 0 else None)
+            for t,seq,c,e in zip(*arrays)]
+
+
+def _histogram_add (hist, value):
+  """
+  Counts value in hist, a dict of bucket -> count
+
+  There are four buckets per power of two, so they're within ~20%.
+  """
+  if value <= 0:
+    bucket = -4000 # Effectively zero
+  else:
+    m,e = math.frexp(value)
+    bucket = e * 4 + int(m * 8) - 4
+  hist[bucket] = hist.get(bucket, 0) + 1
+
+
+def _histogram_percentile (hist, count, fraction):
+  """ Estimates a percentile from a histogram (as a bucket's top) """
+  if not hist: return 0.0
+  want = count * fraction
+  seen = 0
+  for bucket in sorted(hist):
+    seen += hist[bucket]
+    if seen >= want: break
+  e,sub = divmod(bucket, 4)
+  return math.ldexp((sub + 5) / 8.0, e)
+
+
+_perf_counter = getattr(time, "perf_counter", time.time) # Not in Python 2
+
+
+class Profiler (object):
+  """
+  Keeps track of how long the World spends in each kind of event handler
+
+  Handlers are grouped by (entity class, method), e.g., DVRouter.handle_rx.
+  For each, it keeps the number of calls, total and max time, and a
+  histogram from which it estimates the median and 99th percentile.  If filename is set, the stats are
+  written there as JSON when the simulator exits.
+
+  Some events call several handlers (a TimerBatch runs all its timers, and
+  a cable delivers packets to the entity at the other end).  Those time
+  each handler with call(), which takes its time out of the event's.
+  """
+  def __init__ (self, filename = None):
+    self.filename = filename
+    self.stats = {} # name -> [calls, total, max, {bucket:count}]
+    self._cache = _HandlerCache(self._entry)
+    self._inner = 0.0 # Time in call()s within the current one
+
+  def call (self, method, args = (), kw = {}):
+    """
+    Calls method(*args, **kw), timing it separately
+
+    Its time counts for method, and not for whatever it was called from.
+    Returns what method returned.
+    """
+    outer = self._inner
+    self._inner = 0.0
+    start = _perf_counter()
+    try:
+      return method(*args, **kw)
+    finally:
+      elapsed = _perf_counter() - start
+      self.add(method, args, elapsed - self._inner)
+      self._inner = outer + elapsed
+
+  def add (self, method, args, elapsed):
+    """ Adds a call to method (with args) which took elapsed seconds """
+    entry = self._cache.get(method, args)
+    entry[0] += 1
+    entry[1] += elapsed
+    if elapsed > entry[2]: entry[2] = elapsed
+    _histogram_add(entry[3], elapsed)
+
+  def _entry (self, method):
+    """ The stats entry for a callable """
+    name = self._name(method)
+    entry = self.stats.get(name)
+    if entry is None:
+      entry = self.stats[name] = [0, 0.0, 0.0, {}]
+    return entry
+
+  @staticmethod
+  def _name (method):
+    obj = getattr(method, "__self__", None)
+    if isinstance(obj, Timer) and obj.func is not None:
+      method = obj.func
+      obj = getattr(method, "__self__", None)
+    func = getattr(method, "__func__", method)
+    name = getattr(func, "__name__", None) or str(func)
+    if obj is not None:
+      return type(obj).__name__ + "." + name
+    return getattr(func, "__qualname__", name)
+
+  def results (self):
+    """
+    Returns a dict of name -> dict of stats
+
+    The stats are calls, total, mean, p50, p99, and max, with times in
+    seconds.
+    """
+    r = {}
+    for name,(calls,total,most,hist) in self.stats.items():
+      r[name] = dict(calls=calls, total=total, mean=total/calls,
+                     p50=min(most, _histogram_percentile(hist, calls, 0.5)),
+                     p99=min(most, _histogram_percentile(hist, calls, 0.99)),
+                     max=most)
+    return r
+
+  def report (self, sort = "total", limit = None):
+    """ Returns a table of the results, sorted by the given stat """
+    results = sorted(self.results().items(), key=lambda kv: kv[1][sort],
+                     reverse=True)
+    if limit is not None: results = results[:limit]
+    width = max([len(n) for n,_ in results] + [7])
+    lines = ["%-*s %9s %10s %9s %9s %9s %9s" % (width, "Handler", "Calls",
+             "Total(ms)", "Mean(us)", "p50(us)", "p99(us)", "Max(us)")]
+    for name,r in results:
+      lines.append("%-*s %9d %10.1f %9.1f %9.1f %9.1f %9.1f" % (width, name,
+                   r['calls'], r['total'] * 1e3, r['mean'] * 1e6,
+                   r['p50'] * 1e6, r['p99'] * 1e6, r['max'] * 1e6))
+    return "\n".join(lines)
+
+  def dump (self, filename = None):
+    """ Writes the results to a file as JSON """
+    import json
+    if filename is None: filename = self.filename
+    with open(filename, "w") as f:
+      json.dump(self.results(), f, indent=2, sort_keys=True)
+
+
+class WorldStats (object):
+  """
+  Keeps track of how well the World is keeping up in real time
+
+  Every event dispatched by the real-time loop counts toward the lag
+  histogram (how long after its scheduled time it actually ran).  About
+  every INTERVAL real seconds, a sample of the queue depth, events per
+  second, and simulated seconds per real second is added to samples
+  (which keeps the last SAMPLES of them).  Nothing is collected in
+  virtual time.
+  """
+  INTERVAL = 1.0
+  SAMPLES = 300
+
+  def __init__ (self):
+    self.reset()
+
+  def reset (self):
+    self.dispatched = 0
+    self.lag_total = 0.0
+    self.lag_max = 0.0
+    self.lag_histogram = {}
+    self.samples = deque(maxlen=self.SAMPLES) # Sample tuples (see sample())
+    self.next_sample = 0 # Simulated time of the next sample
+    self._last = None # (real time, simulated time, dispatched) last sample
+
+  def add_lag (self, lag):
+    """ Counts an event which ran lag seconds late """
+    self.dispatched += 1
+    self.lag_total += lag
+    if lag > self.lag_max: self.lag_max = lag
+    _histogram_add(self.lag_histogram, lag)
+
+  def sample (self, world, now):
+    """
+    Takes a sample
+
+    now is the scheduled time of the event being dispatched.  Samples are
+    (real time, now, queue depth, events per second, simulated seconds per
+    real second) tuples.  The rates are since the previous sample, so if
+    events are running later and later, the last one drops below the time
+    scale.
+    """
+    real = time.time()
+    if self._last is not None:
+      last_real,last_now,last_dispatched = self._last
+      elapsed = real - last_real
+      if elapsed > 0:
+        self.samples.append((real, now, world.pending,
+                             (self.dispatched - last_dispatched) / elapsed,
+                             (now - last_now) / elapsed))
+    self._last = (real, now, self.dispatched)
+    self.next_sample = now + self.INTERVAL * world.time_scale
+    if world.stats_info:
+      world.info = self.summary()
+
+  def _latest (self, index):
+    if not self.samples: return None
+    return self.samples[-1][index]
+
+  @property
+  def queue_depth (self):
+    """ Events pending as of the last sample """
+    return self._latest(2)
+
+  @property
+  def events_per_second (self):
+    return self._latest(3)
+
+  @property
+  def time_ratio (self):
+    """ Simulated seconds per real second (ideally the time scale) """
+    return self._latest(4)
+
+  def lag_percentile (self, fraction):
+    return _histogram_percentile(self.lag_histogram, self.dispatched,
+                                 fraction)
+
+  def as_dict (self):
+    return dict(dispatched=self.dispatched,
+                lag_mean=self.lag_total / self.dispatched
+                         if self.dispatched else 0.0,
+                lag_p50=min(self.lag_max, self.lag_percentile(0.5)),
+                lag_p99=min(self.lag_max, self.lag_percentile(0.99)),
+                lag_max=self.lag_max, queue_depth=self.queue_depth,
+                events_per_second=self.events_per_second,
+                time_ratio=self.time_ratio)
+
+  def summary (self):
+    """ A one-line summary """
+    d = self.as_dict()
+    s = "%(dispatched)s events, lag p50 %(lag_p50).4fs p99 %(lag_p99).4fs "
+    s += "max %(lag_max).4fs"
+    s = s % d
+    if self.samples:
+      s += ", queue %(queue_depth)s, %(events_per_second).0f events/s, "
+      s += "%(time_ratio).2fx real time"
+      s = s % d
+    return s
+
+  def __str__ (self):
+    return self.summary()
 
 
 world = None
 events = None
 
+_NO_KW = {} # Shared (and never modified) kw for events which don't have any
+
 
 class World (object):
   """ Mostly this dispatches events in the simulator. """
@@ -153,9 +814,27 @@ class World (object):
     global world
     world = self
 
-    self.queue = Queue.PriorityQueue()
+    # The event queue is a plain heap which only the simulation thread
+    # touches.  Other threads (e.g., comm and the console) put events in
+    # the inbox instead, and the simulation thread moves them over.
+    self.queue = []
+    self._inbox = deque()
+    self._wakeup = threading.Condition() # Signalled when inbox gets work
+    self._ident = None # Thread ident of whoever owns the queue
     self._thread = None
-    self._count = 0
+    self._count = itertools.count()
+
+    # Timers are kept separately (see TimingWheel)
+    self._timers = TimingWheel()
+    self._timer_batches = {} # (seconds, slot) -> TimerBatch
+
+    # Cancelled events are just marked (see cancel()) and skipped later,
+    # but we throw them out en masse if they start taking up too much room.
+    self._cancelled = 0 # Cancelled events not yet thrown out
+    self.compact_fraction = 0.5
+    self.compact_minimum = 1024
+    self.cancel_stats = dict(cancelled=0, skipped=0, compacted=0,
+                             compactions=0)
     self.ended = False
 
     # When the world isn't running, items are put in the prelist.
@@ -173,12 +852,31 @@ class World (object):
     self._info = "<No Info!>"
 
     self._time = 0.0 # For virtual time
+
+    # In real time, the clock runs time_scale times as fast as the wall
+    # clock, counting from this (wall clock time, simulated time) origin.
+    self._time_origin = (time.time(), time.time())
+    self._time_scale = 1.0
+    self.time_scale = sim.config.time_scale
     self.max_timeout = 10
 
-    self.trace = False
+    self.trace = False # Print each event as it's dispatched
+    self.tracer = None # Records events cheaply (see Tracer)
+    if sim.config.trace_file:
+      self.tracer = Tracer(sim.config.trace_size, sim.config.trace_file)
+    self.stats = WorldStats() # How the real-time loop is keeping up
+    self.stats_info = sim.config.stats_info # Show stats as NetVis info
+    self.profiler = None # Times event handlers (see Profiler)
+    if sim.config.profile:
+      self.profiler = Profiler(sim.config.profile_file)
+      if sim.config.profile_file:
+        import atexit
+        atexit.register(self._dump_profile)
     self._running = True
 
-    self.virtual_time = False
+    self.virtual_time = sim.config.virtual_time
+    if sim.config.asyncio:
+      self.run = self._run_asyncio
 
     import sim.api as api
     api.netvis._a = lambda : _getEntByName(self.a)
@@ -198,12 +896,19 @@ class World (object):
 
     global events
     should_sleep = sim.config.interactive
-    if sim.config.remote_interface == "tcp":
+    if sim.config.asyncio and sim.config.remote_interface in ("tcp", "web"):
+      # Served on the event loop once the world starts (see sim.aio)
+      import sim.comm_aio as interface
+      should_sleep = False
+    elif sim.config.remote_interface == "tcp":
       import sim.comm_tcp as interface
     elif sim.config.remote_interface == "udp":
       import sim.comm_udp as interface
     elif sim.config.remote_interface == "web":
       import sim.comm_web as interface
+    elif sim.config.remote_interface == "batch":
+      import sim.batch as interface
+      should_sleep = False
     else:
       import sim.comm as interface
       should_sleep = False
@@ -212,6 +917,17 @@ class World (object):
       # Sleep a sec to allow remote to possibly connect
       time.sleep(1)
 
+    # Recording or replaying (see sim.replay)
+    self.recorder = None
+    self.replayer = None
+    if sim.config.record_file:
+      from sim.replay import Recorder
+      self.recorder = Recorder(self, sim.config.record_file,
+                               sim.config.record_seed)
+    elif sim.config.replay_file:
+      from sim.replay import Replayer
+      self.replayer = Replayer(self, sim.config.replay_file)
+
   @property
   def virtual_time (self):
     return self._get_time == self._get_time_virtual
@@ -224,11 +940,36 @@ class World (object):
       setattr(self, attr, getattr(self, prefix+attr+extra))
 
   def stop (self):
-    self._running = False
+    with self._wakeup:
+      self._running = False
+      self._wakeup.notify()
 
   def _get_time_real (self):
-    #if self._start_time is None:
-    return time.time()
+    real,simulated = self._time_origin
+    return simulated + (time.time() - real) * self._time_scale
+
+  @property
+  def time_scale (self):
+    """
+    How many simulated seconds pass per real second (when not in virtual time)
+
+    Everything in the simulator (timers, cable latencies, and so on) is in
+    simulated seconds, so turning this up just makes it all go faster.
+    """
+    return self._time_scale
+
+  @time_scale.setter
+  def time_scale (self, time_scale):
+    time_scale = float(time_scale)
+    if time_scale <= 0:
+      raise ValueError("Time scale must be positive")
+    with self._wakeup:
+      self._time_origin = (time.time(), self._get_time_real())
+      self._time_scale = time_scale
+      self._wakeup.notify() # Whatever it's waiting for is now sooner/later
+
+  def _get_time_virtual (self):
+    return self._time
 
   @property
   def time (self):
@@ -249,11 +990,147 @@ class World (object):
 
   def _real_doLater (_self, _seconds, _method, *_args, **_kw):
     t = _self.time + _seconds
-    _self._real_doAt(t, _method, *_args, **_kw)
+    return _self._real_doAt(t, _method, *_args, **_kw)
 
   def _real_doAt (_self, _t, _method, *_args, **_kw):
-    _self.queue.put((_t, _self._count, _method, _args, _kw))
-    _self._count += 1
+    o = [_t, next(_self._count), _method, _args, _kw]
+    if _get_ident() == _self._ident:
+      heapq.heappush(_self.queue, o)
+    else:
+      with _self._wakeup:
+        _self._inbox.append(o)
+        _self._wakeup.notify()
+    return o
+
+  def _real_doTimerLater (_self, _seconds, _method, *_args, **_kw):
+    t = _self.time + _seconds
+    return _self._real_doTimerAt(t, _method, *_args, **_kw)
+
+  def _real_doTimerAt (_self, _t, _method, *_args, **_kw):
+    if _get_ident() == _self._ident:
+      o = [_t, next(_self._count), _method, _args, _kw]
+      _self._timers.add(o)
+      return o
+    else:
+      # Only the simulation thread touches the wheel, so go via the inbox
+      return _self._real_doAt(_t, _method, *_args, **_kw)
+
+  def _schedule (self, t, method):
+    """
+    Like doAt() for a method which takes no arguments, but cheaper
+
+    On the simulation thread, this skips packing up (empty) arguments, so
+    the event record is the only thing allocated.
+    """
+    if _get_ident() != self._ident:
+      return self.doAt(t, method)
+    o = [t, next(self._count), method, (), _NO_KW]
+    heapq.heappush(self.queue, o)
+    return o
+
+  def _schedule_timer (self, seconds, method):
+    """ Like doTimerLater() for a method which takes no arguments """
+    if _get_ident() != self._ident:
+      return self.doTimerLater(seconds, method)
+    o = [self.time + seconds, next(self._count), method, (), _NO_KW]
+    self._timers.add(o)
+    return o
+
+  def _real_doTimerBatchLater (_self, _seconds, _timer):
+    if _get_ident() == _self._ident:
+      TimerBatch.add(_seconds, _timer)
+    else:
+      # Batches belong to the simulation thread too
+      _self._real_doAt(_self.time, TimerBatch.add, _seconds, _timer)
+
+  def _drain_inbox (self):
+    """ Moves events scheduled by other threads into the queue """
+    inbox = self._inbox
+    while inbox:
+      heapq.heappush(self.queue, inbox.popleft())
+
+  def cancel (self, event):
+    """
+    Cancels an event returned by doLater(), doAt(), etc.
+
+    This is O(1): the event is just marked dead and is skipped when it comes
+    up.  If dead events get to be more than compact_fraction of everything
+    that's scheduled, they're all thrown out at once.  Cancelling None or
+    an event which has already run does nothing.
+    """
+    if event is None or event[2] is None: return
+    event[2] = None
+    event[3] = event[4] = None
+    self._cancelled += 1
+    self.cancel_stats['cancelled'] += 1
+    if (self._cancelled > self.compact_minimum
+        and _get_ident() == self._ident
+        and self._cancelled > self.compact_fraction * self.pending):
+      self._compact()
+
+  def _compact (self):
+    """ Throws out cancelled events """
+    queue = self.queue
+    alive = [o for o in queue if o[2] is not None]
+    removed = len(queue) - len(alive)
+    heapq.heapify(alive)
+    queue[:] = alive
+    removed += self._timers.compact()
+    self._cancelled -= removed
+    self.cancel_stats['compacted'] += removed
+    self.cancel_stats['compactions'] += 1
+
+  @property
+  def pending (self):
+    """ The number of events scheduled (including cancelled ones) """
+    return len(self.queue) + len(self._timers) + len(self._inbox)
+
+  @property
+  def cancelled (self):
+    """ The number of cancelled events still taking up space """
+    return self._cancelled
+
+  def _next_event (self):
+    """
+    Returns the next event (without removing it) or None
+
+    That's whichever is earlier of the head of the queue and the next timer.
+    Cancelled events are thrown away along the way.
+    """
+    queue = self.queue
+    while queue and queue[0][2] is None:
+      heapq.heappop(queue)
+      self._skipped()
+    timers = self._timers
+    o = timers.peek()
+    while o is not None and o[2] is None:
+      timers.pop()
+      self._skipped()
+      o = timers.peek()
+    if queue and (o is None or queue[0] < o):
+      return queue[0]
+    return o
+
+  def _skipped (self):
+    self._cancelled -= 1
+    self.cancel_stats['skipped'] += 1
+
+  def _pop_event (self, o):
+    """ Removes o, which was just returned by _next_event() """
+    if self.queue and self.queue[0] is o:
+      heapq.heappop(self.queue)
+    else:
+      self._timers.pop()
+
+  def _wait (self, timeout = None):
+    """
+    Waits until timeout passes or another thread schedules something
+
+    A timeout of None waits as long as it takes.
+    """
+    with self._wakeup:
+      if self._running and not self._inbox:
+        self._wakeup.wait(timeout)
 
   @property
   def info (self):
@@ -272,9 +1149,9 @@ class World (object):
     assert self._thread is None
     simlog.info("Starting simulation.")
 
-    for a,b,c,d in self._prelist:
-      self._real_doLater(a, b, *c, **d)
-    self._prelist = []
+    self._ident = _get_ident()
+    self._flush_prelist()
+    self._ident = None # The run loop claims the queue
 
     if threaded:
       self._thread = threading.Thread(target=self.run)
@@ -284,20 +1161,56 @@ class World (object):
       self._thread = threading.current_thread()
       self.run()
 
+  def _flush_prelist (self):
+    """ Schedules everything that was scheduled before we started """
+    for f,a,b,c,d in self._prelist:
+      f(a, b, *c, **d)
+    self._prelist = []
+
   def do (self, _method, *args, **kw):
-    self.doLater(0, _method, *args, **kw)
+    return self.doLater(0, _method, *args, **kw)
 
   def doLater (_self, _seconds, _method, *_args, **_kw):
+    """
+    Schedules _method to be called in _seconds
+
+    Returns the event, which can be passed to cancel().  Before the world
+    has started, it returns None.
+    """
     if _self._thread is not None:
-      _self._real_doLater(_seconds, _method, *_args, **_kw)
+      return _self._real_doLater(_seconds, _method, *_args, **_kw)
     else:
-      _self._prelist.append((_seconds, _method, _args, _kw))
+      _self._prelist.append((_self._real_doLater, _seconds, _method, _args, _kw))
 
   def doAt (_self, _time, _method, *_args, **_kw):
     if _self._thread is not None:
-      _self._real_doAt(_time, _method, *_args, **_kw)
+      return _self._real_doAt(_time, _method, *_args, **_kw)
+    else:
+      _self._prelist.append((_self._real_doLater, _time-_self.time, _method,
+                             _args, _kw))
+
+  def doTimerLater (_self, _seconds, _method, *_args, **_kw):
+    """
+    Like doLater(), but for timers
+
+    These go in a TimingWheel instead of the main queue, which is cheaper
+    when there are lots of them.
+    """
+    if _self._thread is not None:
+      return _self._real_doTimerLater(_seconds, _method, *_args, **_kw)
+    else:
+      _self._prelist.append((_self._real_doTimerLater, _seconds, _method,
+                             _args, _kw))
+
+  def doTimerBatchLater (_self, _seconds, _timer):
+    """
+    Schedules a Timer to go off in a TimerBatch
+    """
+    if _self._thread is not None:
+      _self._real_doTimerBatchLater(_seconds, _timer)
     else:
-      _self._prelist.append((_time-_self.time, _method, _args, _kw))
+      _self._prelist.append((_self._real_doTimerBatchLater, _seconds, _timer,
+                             (), {}))
 
   def sleep (self, seconds):
     """
@@ -314,51 +1227,269 @@ class World (object):
     self.doAt(time, event.set)
     event.wait()
 
+  def fork_scenarios (self, scenarios, seconds = None, collect = None,
+                      processes = None):
+    """
+    Tries out each of several what-ifs in a forked copy of the world
+
+    Each scenario is a callable which perturbs the world somehow (e.g., by
+    failing a link).  For each one, we fork a child process which calls it
+    and then runs in virtual time until there's nothing left to do or until
+    the given number of seconds have passed.  Since the child is a
+    copy-on-write copy, the world itself is left as it was.
+
+    Returns a list with a result dict for each scenario.  These have the
+    child's final time, the number of events it ran, and whether it ran
+    out of things to do ("quiescent"), plus whatever collect() returned in
+    the child (if given).  If a scenario fails, its result has an "error"
+    with the traceback instead.  At most processes (by default, the number
+    of CPUs) children run at a time.
+
+    If called from outside the simulation thread while the world is
+    running, this waits for the simulation thread to do it.
+    """
+    if (self._thread is not None and not self.ended
+        and _get_ident() != self._ident):
+      done = threading.Event()
+      results = []
+      def fork ():
+        try:
+          results.append(self.fork_scenarios(scenarios, seconds, collect,
+                                             processes))
+        finally:
+          done.set()
+      self.do(fork)
+      done.wait()
+      if not results:
+        raise RuntimeError("Couldn't fork scenarios")
+      return results[0]
+
+    import os
+    import select
+    from multiprocessing import Pipe, cpu_count
+
+    if processes is None:
+      try:
+        processes = cpu_count()
+      except NotImplementedError:
+        processes = 1
+    results = [None] * len(scenarios)
+    todo = list(enumerate(scenarios))
+    todo.reverse()
+    running = {} # connection -> (index, pid)
+    while todo or running:
+      while todo and len(running) < processes:
+        n,scenario = todo.pop()
+        reader, writer = Pipe(False)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+          try:
+            reader.close()
+            try:
+              result = self._run_scenario(scenario, seconds, collect)
+              writer.send(result)
+            except BaseException:
+              writer.send(dict(error=traceback.format_exc()))
+          finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0)
+        writer.close()
+        running[reader] = (n, pid)
+
+      for reader in select.select(list(running), [], [])[0]:
+        n,pid = running.pop(reader)
+        try:
+          results[n] = reader.recv()
+        except EOFError:
+          results[n] = dict(error="Scenario process exited unexpectedly")
+        reader.close()
+        os.waitpid(pid, 0)
+
+    return results
+
+  def _run_scenario (self, scenario, seconds, collect):
+    """
+    Runs a scenario in a forked child (see fork_scenarios())
+    """
+    global events
+    import sim.comm
+    events = sim.comm.NullInterface() # Keep quiet; the GUI is the parent's
+
+    # Whatever threads we had didn't survive the fork, so take over
+    self._wakeup = threading.Condition()
+    self._thread = threading.current_thread()
+    self._ident = _get_ident()
+    self._running = True
+    if not self.virtual_time:
+      self._time = self.time
+      self.virtual_time = True
+    self._flush_prelist()
+    self._drain_inbox()
+
+    scenario()
+
+    end = None if seconds is None else self._time + seconds
+    try:
+      reason,count = self._run_until(end, None, True, None)
+    except SystemExit as e:
+      reason,count = "stopped", getattr(e, "events", 0)
+    quiescent = reason == "idle"
+
+    result = dict(time=self._time, events=count, quiescent=quiescent)
+    if collect is not None:
+      result.update(collect())
+    return result
+
+  def run_until (self, time = None, predicate = None, idle = False,
+                 max_events = None):
+    """
+    Runs the simulation in this thread until something happens
+
+    That's when the clock reaches time, predicate() returns true, or (if
+    idle is set) there's nothing left to do -- whichever comes first.  In
+    that case, it returns True.  If it dispatches max_events events first,
+    runs out of things to do, or something calls stop(), it returns False.
+    In virtual time, this goes as fast as it can, and reaching time sets
+    the clock to exactly that.  Events scheduled for time itself run.
+
+    If the world hasn't been started, this takes it over (so don't start()
+    it later).  It can be called as many times as you like.  Exceptions
+    from events are passed along to the caller.
+    """
+    reason,count = self._run_until(time, predicate, idle, max_events)
+    return reason in ("time", "predicate", "idle")
+
+  def _run_until (self, until, predicate, idle, max_events):
+    """
+    Does the work of run_until()
+
+    Returns (reason, events dispatched).  If an event raises SystemExit,
+    the exception gets an events attribute with the count.
+    """
+    if self._ident != _get_ident():
+      if self._thread is not None and not self.ended:
+        if self._thread.is_alive() and self._ident is not None:
+          raise RuntimeError("The world is running in another thread")
+      self._thread = threading.current_thread()
+      self._ident = _get_ident()
+    self._flush_prelist()
+    self._running = True
+
+    virtual = self.virtual_time
+    count = 0
+    try:
+      while True:
+        if predicate is not None and predicate(): return "predicate", count
+        if not self._running: return "stopped", count
+        if max_events is not None and count >= max_events:
+          return "max_events", count
+        self._drain_inbox()
+
+        o = self._next_event()
+        if o is None:
+          if idle: return "idle", count
+          if until is None:
+            if virtual: return "empty", count
+            timeout = None # Maybe another thread will do something
+          else:
+            if virtual:
+              if until > self._time: self._time = until
+              return "time", count
+            timeout = until - self.time
+            if timeout <= 0: return "time", count
+        elif until is not None and o[0] > until:
+          if virtual:
+            if until > self._time: self._time = until
+            return "time", count
+          timeout = until - self.time
+          if timeout <= 0: return "time", count
+        elif virtual:
+          self._pop_event(o)
+          if o[0] > self._time:
+            self._time = o[0]
+          self._dispatch(o)
+          count += 1
+          continue
+        else:
+          timeout = o[0] - self.time
+          if timeout <= 0:
+            self._pop_event(o)
+            self._dispatch(o)
+            count += 1
+            continue
+
+        if timeout is not None: timeout /= self._time_scale
+        self._wait(timeout)
+    except SystemExit as e:
+      e.events = count
+      raise
+
   def _run_real (self):
-    timeout = None
-    waiting = Queue.PriorityQueue()
+    self._ident = _get_ident()
+    stats = self.stats
 
     try:
       while self._running:
-        try:
-          t = self.time
-          while not waiting.empty():
-            o = waiting.get()
-            if o[0] <= t:
-              self.queue.put(o)
-              timeout = None
-            else:
-              waiting.put(o)
-              o = waiting.get()
-              waiting.put(o)
-              timeout = o[0] - t
-              break
-          #print("World waiting for",timeout)
-
-          o = self.queue.get(True, 5 if timeout is None else timeout)
-        except Exception:
-          #print("empty")
-          continue
+        self._drain_inbox()
+
+        o = self._next_event()
+        if o is not None:
+          now = self.time
+          timeout = o[0] - now
+          if timeout <= 0:
+            # Expired
+            self._pop_event(o)
+            stats.add_lag(-timeout)
+            if now >= stats.next_sample:
+              stats.sample(self, o[0])
+            self._dispatch(o)
+            continue
+        else:
+          timeout = None
+        #print("World waiting for",timeout)
+
+        # Nothing is due yet, so wait for it or for something new
+        if timeout is not None: timeout /= self._time_scale
+        self._wait(timeout)
+    except KeyboardInterrupt:
+      pass
+    except SystemExit:
+      simlog.debug("Simulation stopped")
+      raise
+    except:
+      simlog.exception("Simulation ended due to exception")
+    finally:
+      simlog.debug("Simulation ended")
+      self.ended = True
+      self._dump_trace()
+
+  def _run_virtual (self):
+    """
+    Runs events as fast as possible
 
-        t = self.time
-        if o[0] > t:
-          # Hasn't expired yet...
-          #print("recycle")
-          waiting.put(o)
-          o = waiting.get()
-          waiting.put(o)
-          timeout = o[0] - t
+    The clock jumps straight to the time of each event as it's dispatched,
+    so nothing ever sleeps.  When there's nothing to do, time stands still
+    until something (e.g., the console) schedules more work.
+    """
+    self._ident = _get_ident()
+
+    try:
+      while self._running:
+        self._drain_inbox()
+
+        o = self._next_event()
+        if o is None:
+          self._wait()
           continue
-        # Expired
-        timeout = None
-        if self.trace:
-          if hasattr(o[2], "__self__"):
-            print(o[2].__self__.__class__.__name__ + "." + o[2].__func__.__name__,end='')
-          else:
-            print(o[2],end='')
-          print(o[3],o[4] if len(o[4]) else '')
-        o[2](*o[3],**o[4])
-        self._post_hook()
+        self._pop_event(o)
+
+        # Events scheduled in the past run "now"; time never goes backwards.
+        if o[0] > self._time:
+          self._time = o[0]
+        self._dispatch(o)
     except KeyboardInterrupt:
       pass
     except SystemExit:
@@ -369,6 +1500,55 @@ class World (object):
     finally:
       simlog.debug("Simulation ended")
       self.ended = True
+      self._dump_trace()
+
+  def _run_asyncio (self):
+    """ Runs the world on an asyncio event loop of its own (see sim.aio) """
+    import asyncio
+    import sim.aio
+    try:
+      asyncio.run(sim.aio.run(self))
+    except KeyboardInterrupt:
+      pass
+
+  def _dump_trace (self):
+    tracer = self.tracer
+    if tracer is not None and tracer.filename:
+      try:
+        tracer.dump()
+        simlog.info("Wrote %s traced events to %s", min(tracer.count,
+                    tracer.size), tracer.filename)
+      except Exception:
+        simlog.exception("Couldn't write trace")
+
+  def _dump_profile (self):
+    profiler = self.profiler
+    if profiler is not None and profiler.filename:
+      try:
+        profiler.dump()
+      except Exception:
+        simlog.exception("Couldn't write profile")
+
+  def _dispatch (self, o):
+    method = o[2]
+    o[2] = None # So that cancelling it now does nothing
+    if self.tracer is not None:
+      self.tracer.record(o, method)
+    if self.trace:
+      if hasattr(method, "__self__"):
+        print(method.__self__.__class__.__name__ + "." + method.__func__.__name__,end='')
+      else:
+        print(method,end='')
+      print(o[3],o[4] if len(o[4]) else '')
+    profiler = self.profiler
+    if profiler is None:
+      if o[3] or o[4]:
+        method(*o[3],**o[4])
+      else:
+        method()
+    else:
+      profiler.call(method, o[3], o[4])
+    self._post_hook()
 
   def _post_hook (self):
     pass
@@ -508,6 +1688,12 @@ class TopoNode (object):
     If flood is True, Port can be a port number NOT to flood out of
     or None to flood all ports.
     """
+    if world._ident is not None and _get_ident() != world._ident:
+      # Cables belong to the simulation thread (this also makes sends from
+      # the console show up as events, which is what replays need)
+      world.do(self.send, packet, port, flood)
+      return
+
     if self.ENABLE_TTL:
       packet.ttl -= 1
       if packet.ttl == 0:
@@ -536,14 +1722,31 @@ class TopoNode (object):
 
 
 def _duplicate_packet (p):
+  """
+  Copies a packet for sending out of a port
+
+  The copy starts out sharing everything with the original.  Containers
+  are copied (shallowly) so that whoever gets the copy can change them --
+  except for the ones the packet says are only ever replaced rather than
+  changed in place (its _shared_fields, e.g., trace and the colors), which
+  stay shared until someone assigns a new value.
+  """
   n = type(p).__new__(type(p))
-  for k,v in vars(p).items():
-    if isinstance(v, (dict, tuple, list, set)):
-      setattr(n, k, copy.copy(v))
-    else:
-      setattr(n, k, v)
+  d = p.__dict__.copy()
+  shared = getattr(p, "_shared_fields", ())
+  mutable = _mutable_types
+  for k,v in d.items():
+    t = type(v)
+    m = mutable.get(t)
+    if m is None:
+      m = mutable[t] = issubclass(t, (list, dict, set))
+    if m and k not in shared:
+      d[k] = copy.copy(v)
+  n.__dict__ = d
   return n
 
+_mutable_types = {} # type -> whether _duplicate_packet() copies it
+
 
 _builtin = sys.modules.get('__builtin__', sys.modules.get('builtins')).__dict__
 
@@ -634,3 +1837,190 @@ def topoOf (entity):
     return entity
   t = topo.get(entity, None)
   return t
+
+
+class TestTimingWheel (unittest.TestCase):
+  """ Checks that TimingWheel gives events in the same order as a heap """
+  def _event (self, t):
+    self._seq += 1
+    return [t, self._seq, id, (), {}]
+
+  def setUp (self):
+    self._seq = 0
+
+  def _check (self, wheel, heap, count):
+    """ Pops count events from both, checking they're the same """
+    for _ in range(count):
+      expected = heapq.heappop(heap)
+      self.assertIs(wheel.peek(), expected)
+      self.assertIs(wheel.pop(), expected)
+    self.assertEqual(len(wheel), len(heap))
+
+  def test_random (self):
+    """ Random delays from nothing to beyond the top level """
+    import random
+    r = random.Random(168)
+    wheel = TimingWheel()
+    heap = []
+    now = 0.0
+    for _ in range(20000):
+      if heap and r.random() < 0.45:
+        o = wheel.peek()
+        self.assertIs(o, heap[0])
+        now = o[0]
+        self._check(wheel, heap, 1)
+        continue
+      scale = r.choice([0, TimingWheel.RESOLUTION, 1, 100, 1e4, 1e6])
+      o = self._event(now + r.random() * scale)
+      wheel.add(o)
+      heapq.heappush(heap, o)
+    self._check(wheel, heap, len(heap))
+    self.assertIsNone(wheel.peek())
+
+  def test_same_time (self):
+    """ Simultaneous events come out in the order they were added """
+    wheel = TimingWheel()
+    heap = []
+    for t in [5.0, 1.0, 5.0, 5.0, 1.0, 1e5, 1e5]:
+      o = self._event(t)
+      wheel.add(o)
+      heapq.heappush(heap, o)
+    self._check(wheel, heap, len(heap))
+
+  def test_past (self):
+    """ Events earlier than the wheel's position still come out first """
+    wheel = TimingWheel()
+    heap = []
+    for t in [10.0, 20.0]:
+      o = self._event(t)
+      wheel.add(o)
+      heapq.heappush(heap, o)
+    self._check(wheel, heap, 1)
+    for t in [3.0, 10.0, 15.0]:
+      o = self._event(t)
+      wheel.add(o)
+      heapq.heappush(heap, o)
+    self._check(wheel, heap, len(heap))
+
+  def test_compact (self):
+    """ compact() throws out exactly the cancelled events """
+    import random
+    r = random.Random(4)
+    wheel = TimingWheel()
+    heap = []
+    for _ in range(2000):
+      o = self._event(r.random() * r.choice([1, 100, 1e6]))
+      wheel.add(o)
+      heapq.heappush(heap, o)
+    self._check(wheel, heap, 100) # Turn the wheel some
+    cancelled = r.sample(heap, 500)
+    for o in cancelled:
+      o[2] = None
+    self.assertEqual(wheel.compact(), 500)
+    heap = [o for o in heap if o[2] is not None]
+    heapq.heapify(heap)
+    self.assertEqual(len(wheel), len(heap))
+    self._check(wheel, heap, len(heap))
+
+
+class TestTimerBatch (unittest.TestCase):
+  """ Checks coalesced timers """
+  def setUp (self):
+    global world, events
+    self._saved = (world, events, sim.config.remote_interface,
+                   sim.config.virtual_time)
+    sim.config.remote_interface = None
+    sim.config.virtual_time = True
+    World()
+    self.fired = []
+
+  def tearDown (self):
+    global world, events
+    (world, events, sim.config.remote_interface,
+     sim.config.virtual_time) = self._saved
+
+  def _timer (self, name, one_shot = False, coalesce = True):
+    cls = OneShot if one_shot else Timer
+    return cls(5, lambda: self.fired.append((name, world.time)),
+               coalesce=coalesce)
+
+  def _times (self, name):
+    return [t for n,t in self.fired if n == name]
+
+  def test_together (self):
+    """ Timers due at about the same time share one event """
+    self._timer("a")
+    world.run_until(0.001)
+    self._timer("b")
+    self._timer("c", one_shot=True)
+    world.run_until(16)
+    self.assertEqual(len(world._timer_batches), 1)
+    self.assertEqual([n for n,t in self.fired],
+                     ["a", "b", "c", "a", "b", "a", "b"])
+    self.assertEqual(self._times("a"), [5, 10, 15])
+
+  def test_cancel (self):
+    """ Cancelling one timer leaves the others in its batch alone """
+    self._timer("a")
+    b = self._timer("b")
+    world.run_until(6)
+    b.cancel()
+    world.run_until(16)
+    self.assertEqual(self._times("a"), [5, 10, 15])
+    self.assertEqual(self._times("b"), [5])
+
+  def test_cancel_all (self):
+    """ Cancelling all of a batch's timers cancels its event """
+    a = self._timer("a")
+    b = self._timer("b")
+    world.run_until(1)
+    a.cancel()
+    b.cancel()
+    self.assertEqual(len(world._timer_batches), 0)
+    world.run_until(16)
+    self.assertEqual(self.fired, [])
+
+  def test_cancel_finished (self):
+    """ Cancelling a timer that's already done doesn't affect the batch """
+    self._timer("a")
+    c = self._timer("c", one_shot=True)
+    world.run_until(6)
+    c.cancel()
+    world.run_until(30)
+    self.assertEqual(self._times("a"), [5, 10, 15, 20, 25, 30])
+    self.assertEqual(self._times("c"), [5])
+
+  def test_stop_recurring (self):
+    """ Same for a recurring timer which stopped itself """
+    class Once (Timer):
+      def timer (self):
+        return False
+    self._timer("b")
+    a = Once(5, coalesce=True)
+    world.run_until(6)
+    a.cancel()
+    world.run_until(16)
+    self.assertEqual(self._times("b"), [5, 10, 15])
+
+  def _tick (self):
+    self.fired.append(("tick", world.time))
+
+  def test_profile (self):
+    """ The profiler times each of a batch's timers on its own """
+    world.profiler = Profiler()
+    Timer(5, self._tick, coalesce=True)
+    OneShot(5, self._tick, coalesce=True)
+    world.run_until(16)
+    stats = world.profiler.results()
+    self.assertEqual(stats["TestTimerBatch._tick"]["calls"], 4)
+    self.assertEqual(stats["TimerBatch.timeout"]["calls"], 3)
+
+  def test_trace (self):
+    """ The tracer records each of a batch's timers too """
+    world.tracer = Tracer(100)
+    Timer(5, self._tick, coalesce=True)
+    OneShot(5, self._tick, coalesce=True)
+    world.run_until(11)
+    self.assertEqual([r[2] for r in world.tracer.records()],
+                     ["TimerBatch.timeout"] + ["TestTimerBatch._tick"] * 2 +
+                     ["TimerBatch.timeout", "TestTimerBatch._tick"])
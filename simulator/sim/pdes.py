@@ -0,0 +1,424 @@
+"""
+Parallel (multi-process) execution of the simulator
+
+This runs a simulation across several worker processes in virtual time.
+The entities are split into partitions (keeping neighbors together as much
+as possible), and after the topology has been built, we fork one worker
+per partition.  Each worker has a full copy of the world, but only runs
+the events that belong to its own entities.  Packets which cross from one
+partition to another are pickled (with entities replaced by their names)
+and passed along through the parent.
+
+Synchronization is conservative and window-based.  The lookahead is the
+smallest latency of any cable crossing between partitions: nothing a
+worker does at time t can affect another partition before t + lookahead.
+So in each round, every worker runs everything before (the earliest time
+anyone has something to do) + lookahead, and then they swap packets.
+If there's an end time, the last round also runs the events scheduled for
+exactly then, just like World.run_until() does.
+
+Some caveats:
+ * Start it from a world which has been set up but not started.
+ * Topology changes while running aren't supported.
+ * Events that don't obviously belong to an entity (tasklets, lambdas, and
+   so on) run in every worker, and can only see the entities local to
+   that worker.  Packets sent by entities that aren't local are ignored.
+ * Simultaneous events in different partitions may run in a different
+   order than they would in a single process.
+ * With --trace-file=FILE, each worker writes the trace of its own events
+   to FILE.N, where N is its partition number.
+
+You probably want to start this with boot's --parallel=N option.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import pickle
+import io
+import traceback
+import threading
+import unittest
+from multiprocessing import Pipe
+
+import sim.core as core
+from sim.core import simlog
+import sim.api as api
+from sim.cable import Cable, BasicCable, DumbCable
+
+
+def partition (workers):
+  """
+  Splits the entities into the given number of groups
+
+  Returns a list of sets of entities.  Groups are slices of a breadth-first
+  ordering of the topology, so connected entities tend to stay together.
+  """
+  nodes = sorted(core.topo.values(), key=lambda te: te.entity.name)
+  order = []
+  seen = set()
+  for start in nodes:
+    if start in seen: continue
+    seen.add(start)
+    frontier = [start]
+    while frontier:
+      te = frontier.pop(0)
+      order.append(te.entity)
+      for c in te.ports:
+        if c is None or c.dst in seen: continue
+        seen.add(c.dst)
+        frontier.append(c.dst)
+  per = -(-len(order) // workers) # Round up
+  return [set(order[i:i+per]) for i in range(0, len(order), per)] or [set()]
+
+
+def _cables ():
+  for te in core.topo.values():
+    for c in te.ports:
+      if c is not None:
+        yield c
+
+
+def lookahead (partitions):
+  """
+  Returns the lookahead for the given partitioning
+
+  That's the smallest latency on a cable between partitions (or infinity
+  if there aren't any such cables).
+  """
+  owner = _owners(partitions)
+  la = float("inf")
+  for c in _cables():
+    if owner[c.srcEnt] != owner[c.dstEnt]:
+      la = min(la, c.latency)
+  return la
+
+
+def _owners (partitions):
+  owner = {}
+  for n,p in enumerate(partitions):
+    for e in p:
+      owner[e] = n
+  return owner
+
+
+class _Pickler (pickle.Pickler):
+  """ Pickles entities as just their names """
+  def persistent_id (self, obj):
+    if isinstance(obj, api.Entity):
+      return obj.name
+    return None
+
+  @classmethod
+  def dumps (cls, obj):
+    f = io.BytesIO()
+    cls(f, 2).dump(obj)
+    return f.getvalue()
+
+
+class _Unpickler (pickle.Unpickler):
+  def persistent_load (self, name):
+    return core._getEntByName(name)
+
+  @classmethod
+  def loads (cls, data):
+    return cls(io.BytesIO(data)).load()
+
+
+def _event_owner (method, args):
+  """
+  Figures out which entity an event is for, if any
+  """
+  if method is core._catch and args:
+    return _event_owner(args[0], args[1:])
+  obj = getattr(method, "__self__", None)
+  if isinstance(obj, api.Entity):
+    return obj
+  if isinstance(obj, Cable):
+    # The sending side keeps track of what's on the wire
+    return obj.srcEnt
+  if isinstance(obj, core.Timer):
+    return _event_owner(obj.func, obj.args)
+  if isinstance(obj, core.TopoNode):
+    return obj.entity
+  return None
+
+
+class _Worker (object):
+  def __init__ (self, index, owner, conn, collect):
+    self.index = index
+    self.owner = owner # entity -> partition number
+    self.conn = conn
+    self.collect = collect
+    self.outbox = [] # (dst partition, time, cable key, pickled packet)
+    self.events = 0
+    self.stopped = False
+
+  def _is_local (self, entity):
+    return entity is None or self.owner.get(entity, self.index) == self.index
+
+  def setup (self):
+    world = core.world
+    world._thread = threading.current_thread()
+    world._ident = core._get_ident()
+    world._flush_prelist()
+
+    # Throw away everything that belongs to other partitions
+    for o in list(world.queue) + list(world._timers):
+      method = o[2]
+      if method is None: continue
+      obj = getattr(method, "__self__", None)
+      if isinstance(obj, core.TimerBatch):
+        obj.timers = [t for t in obj.timers
+                      if self._is_local(_event_owner(t.func, t.args))]
+        obj.live = len(obj.timers)
+        if obj.timers: continue
+      elif self._is_local(_event_owner(method, o[3])):
+        continue
+      world.cancel(o)
+
+    self.cables = {}
+    for c in _cables():
+      self.cables[(c.srcEnt.name, c.srcPort)] = c
+      if not self._is_local(c.srcEnt):
+        # Someone else does the sending on this one
+        c.transfer = lambda packet: None
+      elif not self._is_local(c.dstEnt):
+        self._make_boundary(c)
+
+  def _make_boundary (self, cable):
+    """
+    Makes a cable ship packets to the partition at the other end
+    """
+    dst = self.owner[cable.dstEnt]
+    key = (cable.srcEnt.name, cable.srcPort)
+    worker = self
+
+    if isinstance(cable, BasicCable):
+      # Let the cable do its queueing and such, but instead of delivering
+      # the packet itself, we send it along as soon as we know when it
+      # should arrive.
+      original = cable.transfer
+      def transfer (packet):
+        original(packet)
+        for t,p in reversed(cable.queue):
+          if p is packet:
+            worker.outbox.append((dst, t, key, _Pickler.dumps(packet)))
+            break
+      cable.transfer = transfer
+      cable._do_deliver = lambda p, drop: None
+    elif isinstance(cable, DumbCable):
+      def transfer (packet):
+        t = core.world.time + cable.latency
+        worker.outbox.append((dst, t, key, _Pickler.dumps(packet)))
+        core.events.packet(cable.srcEnt.name, cable.dstEnt.name, packet,
+                           cable.latency)
+        packet._notify_tx(cable.srcEnt, cable.srcPort, cable.dstEnt,
+                          cable.dstPort, False)
+      cable.transfer = transfer
+    else:
+      raise RuntimeError("Can't run %s between partitions" % (cable,))
+
+  def _receive (self, cable, packet):
+    if not cable.src or cable.src.ports[cable.srcPort] is not cable:
+      # Disconnected
+      packet._notify_rx(cable.srcEnt, cable.srcPort, cable.dstEnt,
+                        cable.dstPort, True)
+      return
+    packet._notify_rx(cable.srcEnt, cable.srcPort, cable.dstEnt,
+                      cable.dstPort, False)
+    cable.dstEnt.handle_rx(packet, cable.dstPort)
+
+  def run_window (self, end, inclusive, inbound):
+    """
+    Runs the events before end (or at it too, if inclusive)
+    """
+    world = core.world
+    for t,key,data in inbound:
+      packet = _Unpickler.loads(data)
+      world.doAt(t, self._receive, self.cables[key], packet)
+
+    while world._running:
+      o = world._next_event()
+      if o is None or o[0] > end or (o[0] == end and not inclusive): break
+      world._pop_event(o)
+      if o[0] > world._time:
+        world._time = o[0]
+      try:
+        world._dispatch(o)
+      except SystemExit:
+        world._running = False
+      except Exception:
+        simlog.exception("Simulation ended due to exception")
+        world._running = False
+      self.events += 1
+    self.stopped = not world._running
+
+  def serve (self):
+    try:
+      self.setup()
+      self.conn.send(("ready", self._next_time()))
+      while True:
+        msg = self.conn.recv()
+        if msg[0] == "run":
+          _, end, inclusive, inbound = msg
+          self.run_window(end, inclusive, inbound)
+          outbox = self.outbox
+          self.outbox = []
+          self.conn.send(("done", self._next_time(), outbox, self.stopped))
+        else:
+          tracer = core.world.tracer
+          if tracer is not None and tracer.filename:
+            # Each worker only saw its own events, so each gets a file
+            tracer.filename += ".%s" % (self.index,)
+            core.world._dump_trace()
+          result = dict(partition=self.index, events=self.events,
+                        time=core.world.time)
+          if self.collect is not None:
+            result.update(self.collect())
+          self.conn.send(("result", result))
+          break
+    except Exception:
+      traceback.print_exc()
+      try:
+        self.conn.send(("error", traceback.format_exc()))
+      except Exception:
+        pass
+
+  def _next_time (self):
+    o = core.world._next_event()
+    if o is None: return None
+    return o[0]
+
+
+def run (workers, until = None, collect = None):
+  """
+  Runs the (not yet started) world in parallel across worker processes
+
+  Runs until there's nothing left to do, a worker stops (e.g., because
+  something called sys.exit()), or the virtual time reaches until (events
+  scheduled for until itself still run).
+  If collect is specified, it's called in each worker at the end and
+  should return a dict, which gets merged into that worker's results.
+  Returns a list of result dicts, one per partition.
+  """
+  world = core.world
+  assert world._thread is None, "World has already been started"
+  assert world.virtual_time, "Parallel runs need virtual time"
+
+  partitions = partition(int(workers))
+  la = lookahead(partitions)
+  if la <= 0:
+    raise RuntimeError("Parallel runs need cables between partitions to "
+                       "have positive latency")
+  owner = _owners(partitions)
+  simlog.info("Running in parallel: %s partitions (%s), lookahead %s",
+              len(partitions), ", ".join(str(len(p)) for p in partitions), la)
+
+  sys.stdout.flush()
+  sys.stderr.flush()
+  conns = []
+  pids = []
+  for n in range(len(partitions)):
+    parent_conn, child_conn = Pipe()
+    pid = os.fork()
+    if pid == 0:
+      parent_conn.close()
+      try:
+        _Worker(n, owner, child_conn, collect).serve()
+      finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
+    child_conn.close()
+    conns.append(parent_conn)
+    pids.append(pid)
+
+  def recv (conn):
+    msg = conn.recv()
+    if msg[0] == "error":
+      raise RuntimeError("Worker failed:\n" + msg[1])
+    return msg
+
+  try:
+    times = [recv(c)[1] for c in conns]
+    inbound = [[] for _ in conns]
+    while True:
+      pending = [t for t in times if t is not None]
+      pending += [m[0] for box in inbound for m in box]
+      if not pending: break
+      start = min(pending)
+      if until is not None and start > until: break
+      end = start + la
+      last = until is not None and end >= until
+      if last: end = until
+
+      for c,box in zip(conns, inbound):
+        box.sort()
+        c.send(("run", end, last, box))
+      inbound = [[] for _ in conns]
+      stopped = False
+      for n,c in enumerate(conns):
+        _, times[n], outbox, worker_stopped = recv(c)
+        stopped = stopped or worker_stopped
+        for dst,t,key,data in outbox:
+          inbound[dst].append((t, key, data))
+      if stopped: break
+
+    for c in conns:
+      c.send(("finish",))
+    results = [recv(c)[1] for c in conns]
+  finally:
+    for pid in pids:
+      try:
+        os.waitpid(pid, 0)
+      except OSError:
+        pass
+
+  world._time = max(r['time'] for r in results)
+  return results
+
+
+class TestParallel (unittest.TestCase):
+  """ Checks that parallel batch runs report the same as sequential ones """
+  class Ticker (api.Entity):
+    """ Floods a packet every second """
+    def __init__ (self):
+      api.create_timer(1, self.tick)
+
+    def tick (self):
+      self.send(api.Packet(), flood=True)
+
+  def setUp (self):
+    import logging
+    import sim
+    config = sim.config
+    self._saved = (core.world, core.events, config.remote_interface,
+                   config.virtual_time, logging.getLogger().level)
+    logging.getLogger().setLevel(logging.WARNING)
+    config.remote_interface = "batch"
+    config.virtual_time = True
+    core.World()
+    self.tickers = [self.Ticker.create("pdes_test%s" % (i,)) for i in range(6)]
+    for a,b in zip(self.tickers, self.tickers[1:]):
+      a.linkTo(b)
+
+  def tearDown (self):
+    import logging
+    import sim
+    for t in self.tickers:
+      t.remove()
+    (core.world, core.events, sim.config.remote_interface,
+     sim.config.virtual_time, level) = self._saved
+    logging.getLogger().setLevel(level)
+
+  def test_until (self):
+    """ Events scheduled right at the end time run in both """
+    import sim.batch as batch
+    parallel = batch.run(until=5, report=os.devnull, workers=3)
+    core.world._time = 0.0 # The workers were copies, so start over
+    serial = batch.run(until=5, report=os.devnull)
+    self.assertEqual(parallel['sim_time'], 5)
+    self.assertEqual(serial['sim_time'], 5)
+    self.assertEqual(parallel['packets'], serial['packets'])
+    self.assertEqual(parallel['bytes'], serial['bytes'])
@@ -0,0 +1,261 @@
+"""
+Recording and replaying simulation runs
+
+Given the same topology, a run is determined by the random numbers it
+draws and by whatever gets poked into it from outside the simulation
+thread (console commands, NetVis actions, and so on).  So to record a run
+(boot's --record=FILE option), we seed the random number generator and
+log every event which comes in from another thread, along with how many
+events had been dispatched when it showed up.  Replaying (--replay=FILE,
+with the same topology and options otherwise) runs in virtual time and
+slips each recorded event in at the same point, so the whole thing plays
+out again -- just as fast as it can instead of at wall clock speed.
+
+To make real-time recordings replayable, the clock is pinned to each
+event's scheduled time while it is being handled (so that anything it
+schedules lands at the same place in virtual time later), and events
+coming in from other threads are never scheduled in the past.
+
+Some caveats:
+ * Anything done from the console before the simulation starts, or which
+   changes things without scheduling an event, isn't recorded.
+ * Events which can't be pickled (e.g., lambdas typed at the console) are
+   logged as unreplayable and skipped in the replay.
+ * Other threads drawing random numbers in the middle of an event will
+   throw things off (the generator's state is only saved when events come
+   in from outside).
+"""
+
+from __future__ import print_function
+import sys
+import types
+import random
+import pickle
+import heapq
+import atexit
+
+import sim.core as core
+from sim.core import simlog
+from sim.cable import Cable
+import sim.comm as comm
+import sim.pdes as pdes
+
+
+class _Pickler (pdes._Pickler):
+  """ Also refers to cables, topology nodes and GUI connections by name """
+  if sys.version_info[0] < 3:
+    # Python 2 can't pickle bound methods, which is what most events call
+    def _save_method (self, obj):
+      owner = obj.__self__
+      if owner is None: owner = obj.im_class # Unbound
+      self.save_reduce(getattr, (owner, obj.__func__.__name__), obj=obj)
+
+    dispatch = dict(pdes._Pickler.dispatch)
+    dispatch[types.MethodType] = _save_method
+
+  def persistent_id (self, obj):
+    if isinstance(obj, Cable):
+      return ("cable", obj.srcEnt.name, obj.srcPort)
+    if isinstance(obj, core.TopoNode):
+      return ("topo", obj.entity.name)
+    if isinstance(obj, comm.NullInterface):
+      cls = type(obj)
+      return ("interface", cls.__module__, cls.__name__)
+    return pdes._Pickler.persistent_id(self, obj)
+
+
+class _Unpickler (pdes._Unpickler):
+  def persistent_load (self, pid):
+    if not isinstance(pid, tuple):
+      return pdes._Unpickler.persistent_load(self, pid)
+    kind = pid[0]
+    if kind == "interface":
+      # A stand-in which can run the same commands but isn't connected
+      import importlib
+      cls = getattr(importlib.import_module(pid[1]), pid[2])
+      interface = cls.__new__(cls)
+      interface.sock = None
+      return interface
+    te = core.topoOf(core._getEntByName(pid[1]))
+    if kind == "cable":
+      return te.ports[pid[2]]
+    return te
+
+
+class Recorder (object):
+  """
+  Records a run to a file
+
+  The file is a sequence of pickled tuples:
+    ("start", {"seed":seed})
+    ("origin", time)              -- when the world was started
+    ("rng", index, state)         -- random.getstate() after index events
+    ("inject", index, time, data) -- data is the pickled event
+    ("unreplayable", index, time, description)
+    ("end", index, time)
+  """
+  def __init__ (self, world, filename, seed = None):
+    if seed is None:
+      seed = random.SystemRandom().getrandbits(64)
+    random.seed(seed)
+    self.world = world
+    self.filename = filename
+    self.file = open(filename, "wb")
+    self.dispatched = 0
+    self.dispatching = False
+    self._write(("start", dict(seed=seed)))
+
+    self._flush_prelist = world._flush_prelist
+    self._drain = world._drain_inbox
+    self._dispatch = world._dispatch
+    self._run = world.run
+    world._flush_prelist = self._flush_prelist_hook
+    world._drain_inbox = self._drain_inbox_hook
+    world._dispatch = self._dispatch_hook
+    world.run = self._run_hook
+    if not world.virtual_time:
+      world._time = world.time
+      world._get_time = self._get_time
+    atexit.register(self.close)
+    simlog.info("Recording to %s (seed %s)", filename, seed)
+
+  def _write (self, record):
+    if self.file is None: return
+    pickle.dump(record, self.file, 2)
+    self.file.flush()
+
+  def _get_time (self):
+    """ Real time, except pinned to the event time while handling one """
+    world = self.world
+    if self.dispatching:
+      return world._time
+    return world._get_time_real()
+
+  def _flush_prelist_hook (self):
+    world = self.world
+    if not world.virtual_time:
+      world._time = world._get_time_real()
+    self._write(("origin", world._time))
+    self.dispatching = True
+    try:
+      self._flush_prelist()
+    finally:
+      self.dispatching = False
+
+  def _drain_inbox_hook (self):
+    world = self.world
+    inbox = world._inbox
+    if not inbox: return
+    self._write(("rng", self.dispatched, random.getstate()))
+    while inbox:
+      o = inbox.popleft()
+      # Never in the past, and ordered as if it was scheduled just now
+      if o[0] < world._time: o[0] = world._time
+      o[1] = next(world._count)
+      if o[2] is not None:
+        self._record(o)
+      heapq.heappush(world.queue, o)
+
+  def _record (self, o):
+    try:
+      data = _Pickler.dumps((o[2], o[3], o[4]))
+    except Exception as e:
+      simlog.warning("Can't record %s for replay (%s)", o[2], e)
+      self._write(("unreplayable", self.dispatched, o[0], repr(o[2])))
+      return
+    self._write(("inject", self.dispatched, o[0], data))
+
+  def _dispatch_hook (self, o):
+    world = self.world
+    if o[0] > world._time:
+      world._time = o[0]
+    self.dispatching = True
+    try:
+      self._dispatch(o)
+    finally:
+      self.dispatching = False
+      self.dispatched += 1
+
+  def _run_hook (self):
+    try:
+      self._run()
+    finally:
+      self.close()
+
+  def close (self):
+    """ Finishes the recording """
+    if self.file is None: return
+    self._write(("end", self.dispatched, self.world._time))
+    self.file.close()
+    self.file = None
+    simlog.info("Recorded %s events to %s", self.dispatched, self.filename)
+
+
+class Replayer (object):
+  """
+  Replays a run recorded by Recorder
+
+  The world has to be in virtual time.  When it has dispatched as many
+  events as the recorded run did, it stops.
+  """
+  def __init__ (self, world, filename):
+    assert world.virtual_time, "Replays need virtual time"
+    self.world = world
+    self.filename = filename
+    self.dispatched = 0
+    self.origin = None
+    self.end = None
+    self.records = []
+    with open(filename, "rb") as f:
+      header = pickle.load(f)
+      if header[0] != "start":
+        raise RuntimeError("%s is not a recording" % (filename,))
+      while True:
+        try:
+          record = pickle.load(f)
+        except EOFError:
+          break
+        if record[0] == "origin":
+          self.origin = record[1]
+        elif record[0] == "end":
+          self.end = record[1]
+        else:
+          self.records.append(record)
+    self.records.reverse() # So we can pop() them in order
+    random.seed(header[1]['seed'])
+
+    self._flush_prelist = world._flush_prelist
+    self._drain = world._drain_inbox
+    self._dispatch = world._dispatch
+    world._flush_prelist = self._flush_prelist_hook
+    world._drain_inbox = self._drain_inbox_hook
+    world._dispatch = self._dispatch_hook
+    simlog.info("Replaying %s", filename)
+
+  def _flush_prelist_hook (self):
+    if self.origin is not None:
+      self.world._time = self.origin
+    self._flush_prelist()
+
+  def _drain_inbox_hook (self):
+    world = self.world
+    records = self.records
+    while records and records[-1][1] <= self.dispatched:
+      record = records.pop()
+      kind = record[0]
+      if kind == "rng":
+        random.setstate(record[2])
+      elif kind == "inject":
+        method,args,kw = _Unpickler.loads(record[3])
+        o = [record[2], next(world._count), method, args, kw]
+        heapq.heappush(world.queue, o)
+      elif kind == "unreplayable":
+        simlog.warning("Skipping unreplayable event %s", record[3])
+    self._drain()
+
+  def _dispatch_hook (self, o):
+    self._dispatch(o)
+    self.dispatched += 1
+    if self.dispatched == self.end:
+      simlog.info("Replayed all %s recorded events", self.end)
+      self.world.stop()
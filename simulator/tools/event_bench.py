@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for scheduling and dispatching events
+
+Compares the general scheduling path (doAt() with its *args and **kw
+packing) against the no-argument fast path (World._schedule()), which is
+what cables and timers use.  For each, it reports the time per
+schedule+dispatch cycle and the memory held per pending event (which
+needs tracemalloc, so it's left out on Python 2).
+
+Run it from the simulator directory:
+  python tools/event_bench.py [events]
+"""
+
+from __future__ import print_function
+import os
+import sys
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None # Python 2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+import sim
+sim.config.remote_interface = None
+sim.config.console_log = False
+sim.config.virtual_time = True
+import sim.core as core
+import logging
+logging.getLogger().setLevel(logging.ERROR)
+
+
+def _cycle (world, schedule, events):
+  """ Time per event for a method which keeps rescheduling itself """
+  del world.queue[:] # Leftovers from last time
+  left = [events]
+  def tick ():
+    left[0] -= 1
+    if left[0] <= 0:
+      world.stop()
+      return
+    schedule(world.time + 0.001, tick)
+  for _ in range(100):
+    schedule(world.time + 0.001, tick)
+  world._running = True
+  start = core._perf_counter()
+  world._run_virtual()
+  return (core._perf_counter() - start) / events
+
+
+def _held (world, schedule, events):
+  """ Bytes of memory held per pending event (None if we can't tell) """
+  if tracemalloc is None: return None
+  def nothing ():
+    pass
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  for i in range(events):
+    schedule(world.time + i, nothing)
+  after = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  del world.queue[:]
+  return (after - before) / float(events)
+
+
+def main (events = 200000):
+  world = core.World()
+  world._ident = core._get_ident() # We're the simulation thread
+  world._thread = sys.modules['threading'].current_thread()
+
+  paths = [("doAt()", world.doAt), ("_schedule()", world._schedule)]
+  print("%-12s %12s %14s" % ("Path", "ns/event", "bytes/pending"))
+  for name,schedule in paths:
+    best = min(_cycle(world, schedule, events) for _ in range(5))
+    held = _held(world, schedule, events // 2)
+    held = "n/a" if held is None else "%.0f" % (held,)
+    print("%-12s %12.0f %14s" % (name, best * 1e9, held))
+
+
+if __name__ == "__main__":
+  main(*[int(a) for a in sys.argv[1:]])